@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""
+Desc:
+    帧总线：采集线程发布视频帧，显示、检测、录制线程按需取帧
+    环形缓冲区保存最近的若干帧，每帧带有递增的序号和采集时间戳，新帧到达时通过条件变量唤醒等待的线程
+"""
+
+import threading
+import time
+from collections import deque, namedtuple
+
+Frame = namedtuple('Frame', ['seq', 'timestamp', 'image'])  # 序号从1开始，时间戳为采集时刻time.time()
+
+
+class FrameBus:
+    def __init__(self, size=30):
+        self.frames = deque(maxlen=size)  # 环形缓冲区，写满后丢弃最旧的帧
+        self.cond = threading.Condition()
+        self.seq = 0  # 最新一帧的序号，0表示还没有帧
+        self.closed = False
+
+    def publish(self, image):
+        """发布一帧，返回其序号"""
+        with self.cond:
+            self.seq += 1
+            self.frames.append(Frame(self.seq, time.time(), image))
+            self.cond.notify_all()
+            return self.seq
+
+    def latest(self):
+        """最新一帧，没有帧时返回None"""
+        with self.cond:
+            return self.frames[-1] if self.frames else None
+
+    def wait_latest(self, after=0, timeout=None):
+        """等待序号大于after的帧并返回最新一帧(跳过来不及处理的旧帧)，超时或总线关闭后没有新帧返回None"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > after or self.closed, timeout)
+            if self.seq <= after or not self.frames:
+                return None
+            return self.frames[-1]
+
+    def wait_next(self, after=0, timeout=None):
+        """等待并按顺序返回after之后的下一帧，该帧已被挤出缓冲区时返回仍在缓冲区中最旧的帧
+
+        超时或总线关闭后没有新帧返回None，关闭前已发布的帧仍可继续取出
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > after or self.closed, timeout)
+            if self.seq <= after or not self.frames:
+                return None
+            first = self.frames[0].seq  # 缓冲区中最旧的帧
+            return self.frames[max(after + 1 - first, 0)]
+
+    def close(self):
+        """关闭总线，唤醒所有等待的线程"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def reset(self):
+        """清空缓冲区并重新打开"""
+        with self.cond:
+            self.frames.clear()
+            self.seq = 0
+            self.closed = False
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Desc:
+    NMS引擎(greedy/matrix/cluster/soft)在密集合成场景上的耗时对比
+    每张图中随机放置若干目标，每个目标周围生成大量抖动的候选框，模拟拥挤画面中NMS前的检测输出
+    用法: python helper/benchmark_nms.py [--device 0] [--batch 16] [--objects 50 200 800]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))  # 项目根目录
+
+from utils.general import NMS_ENGINES, non_max_suppression
+from utils.metrics import box_iou
+from utils.torch_utils import select_device
+
+
+def dense_scene(batch, objects, candidates=30, nc=80, size=640, device='cpu'):
+    """合成(batch, objects * candidates, 5 + nc)的模型输出，xywh为像素坐标"""
+    n = objects * candidates
+    p = torch.zeros(batch, n, 5 + nc, device=device)
+    xy = torch.rand(batch, objects, 1, 2, device=device) * size
+    wh = torch.rand(batch, objects, 1, 2, device=device) * size / 8 + 8
+    jitter = torch.randn(batch, objects, candidates, 4, device=device) * 0.08
+    p[..., :2] = (xy + jitter[..., :2] * wh).view(batch, n, 2)
+    p[..., 2:4] = (wh * (1 + jitter[..., 2:])).view(batch, n, 2)
+    p[..., 4] = torch.rand(batch, n, device=device) * 0.7 + 0.3  # obj conf
+    cls = torch.randint(nc, (batch, objects, 1), device=device).expand(-1, -1, candidates).reshape(batch, n)
+    p.scatter_(2, cls[..., None] + 5, 1.0)  # one class per object
+    return p
+
+
+def recall(det, ref, iou=0.7):
+    """greedy NMS保留的框中被det以同类IoU>iou覆盖的比例"""
+    if not len(ref):
+        return 1.0
+    if not len(det):
+        return 0.0
+    match = (box_iou(ref[:, :4], det[:, :4]) > iou) & (ref[:, 5:6] == det[:, 5].view(1, -1))
+    return match.any(1).float().mean().item()
+
+
+def run(device='cpu', batch=16, objects=(50, 200, 800), conf_thres=0.25, iou_thres=0.45, repeat=10):
+    device = select_device(device)
+    print(f'{"objects":>8}{"engine":>10}{"time(ms)":>12}{"kept/img":>10}{"recall":>10}')
+    for n in objects:
+        p = dense_scene(batch, n, device=device)
+        ref = non_max_suppression(p.clone(), conf_thres, iou_thres)
+        for engine in NMS_ENGINES:
+            non_max_suppression(p.clone(), conf_thres, iou_thres, engine=engine)  # warmup
+            dt = 0
+            for _ in range(repeat):
+                x = p.clone()
+                if device.type != 'cpu':
+                    torch.cuda.synchronize()
+                t = time.perf_counter()
+                y = non_max_suppression(x, conf_thres, iou_thres, engine=engine)
+                if device.type != 'cpu':
+                    torch.cuda.synchronize()
+                dt += time.perf_counter() - t
+            kept = sum(len(d) for d in y) / batch
+            r = sum(recall(d, g) for d, g in zip(y, ref)) / batch
+            print(f'{n:>8}{engine:>10}{dt / repeat * 1000:>12.1f}{kept:>10.1f}{r:>10.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cpu', help='cuda device, i.e. 0 or cpu')
+    parser.add_argument('--batch', type=int, default=16, help='images per batch')
+    parser.add_argument('--objects', type=int, nargs='+', default=[50, 200, 800], help='objects per image')
+    parser.add_argument('--repeat', type=int, default=10, help='timed runs per engine')
+    opt = parser.parse_args()
+    run(opt.device, opt.batch, opt.objects, repeat=opt.repeat)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""
+Desc:
+    将训练得到的*.pt权重转换为内存映射格式*.mmap(已融合、去除ema和优化器等)，
+    启动时无需反序列化整个checkpoint，多个进程加载同一模型时共享内存页
+    --classes只保留部分类别的检测头输出(类别序号)，输出文件名附加类别序号
+    导出后检查*.mmap与原*.pt的输出一致，并对比两者的加载耗时(*.mmap应快于torch.load，小模型两者都在0.1s以内)
+    用法: python helper/export_mmap.py weights/yolov5s.pt [weights/yolov5m.pt ...] [--classes 0 2 7]
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))  # 项目根目录
+
+import torch
+
+from models.experimental import attempt_load, load_mmap, save_mmap
+
+
+def check(w, f, model, repeat=3):
+    """对比*.pt与*.mmap的加载耗时(取多次中的最小值)，并检查两者输出一致"""
+    t_pt = t_mmap = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        torch.load(w, map_location='cpu')
+        t_pt = min(t_pt, time.perf_counter() - t)
+        t = time.perf_counter()
+        loaded = load_mmap(f)
+        t_mmap = min(t_mmap, time.perf_counter() - t)
+    img = torch.rand(1, 3, 256, 256) * (255 if model.raw_input else 1)
+    with torch.no_grad():
+        diff = (model(img)[0] - loaded(img)[0]).abs().max().item()
+    print(f'torch.load {t_pt:.3f}s, load_mmap {t_mmap:.3f}s ({t_pt / t_mmap:.1f}x), max output diff {diff:.2g}')
+    assert t_mmap < max(t_pt, 0.1), f'{f} loads slower than {w}'
+    assert diff < 1e-4, f'{f} outputs differ from {w}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('weights', nargs='+', help='*.pt weights')
+    parser.add_argument('--classes', type=int, nargs='+', help='keep only these classes in the Detect head')
+    opt = parser.parse_args()
+    for w in opt.weights:
+        model = attempt_load(w, map_location='cpu')
+        f = Path(w).with_suffix('.mmap')
+        if opt.classes:
+            model.prune_classes(opt.classes)
+            f = f.with_name(f'{f.stem}_c{"-".join(map(str, opt.classes))}.mmap')
+        save_mmap(model, f)
+        print(f'{w} -> {f}')
+        check(w, f, model)
@@ -1,4 +1,10 @@
 import sys
+
+import profiler
+
+if '--profile-startup' in sys.argv:
+    profiler.enable()  # 需在导入其他模块之前开始统计
+
 import threading
 import platform
 import time
@@ -39,14 +45,16 @@ class MainWindow(QMainWindow):
         self.setWindowTitle(f'{APP_NAME} {APP_VERSION}')
         self.setWindowIcon(QIcon('img/yologo.png'))
 
-        gb.init_logger()
-        gb.clean_log()
-        gb.init_config()
+        with profiler.stage('初始化日志及配置'):
+            gb.init_logger()
+            gb.clean_log()
+            gb.init_config()
 
-        self.camera = WidgetCamera()  # 摄像头
-        self.info = WidgetInfo()  # 信息面板
-        self.config = WidgetConfig()  # Yolo配置界面
-        self.settings = SettingsDialog()
+        with profiler.stage('创建界面组件'):
+            self.camera = WidgetCamera()  # 摄像头
+            self.info = WidgetInfo()  # 信息面板
+            self.config = WidgetConfig()  # Yolo配置界面
+            self.settings = SettingsDialog()
 
         self.signal_config_error.connect(self.slot_msg_dialog)
 
@@ -119,10 +127,14 @@ class MainWindow(QMainWindow):
                 fps = 0 if self.config.check_camera.isChecked() else 30
                 self.camera.show_camera(fps=fps)  # 显示画面
                 if self.config.check_record.isChecked():
-                    self.camera.run_video_recorder()  # 录制视频
+                    self.camera.run_video_recorder(fps=fps)  # 录制视频
                 if self.load_model_thread.is_alive():
                     self.load_model_thread.join()
-                self.camera.start_detect()  # 目标检测
+                self.camera.start_detect(pipeline=self.settings.check_pipeline.isChecked(),
+                                         budget=self.settings.budget(),
+                                         motion=self.settings.spin_motion.value() / 100,
+                                         track=int(self.settings.spin_track.value()),
+                                         adaptive=self.settings.check_adaptive.isChecked())  # 目标检测
                 self.update_info()
 
     def load_yolo(self):
@@ -139,11 +151,37 @@ class MainWindow(QMainWindow):
             agnostic=self.settings.check_agnostic.isChecked(),
             augment=self.settings.check_augment.isChecked(),
             half=self.settings.check_half.isChecked(),
-            dnn=self.settings.check_dnn.isChecked()
+            dnn=self.settings.check_dnn.isChecked(),
+            reuse_buffer=self.settings.check_buffer.isChecked(),
+            raw_input=self.settings.check_raw.isChecked(),
+            ort_intra_threads=int(self.settings.spin_ort_intra.value()),
+            ort_inter_threads=int(self.settings.spin_ort_inter.value()),
+            ort_parallel=self.settings.combo_ort_mode.currentText() == 'parallel',
+            ort_opt_level=self.settings.combo_ort_level.currentText(),
+            ort_save_optimized=self.settings.check_ort_save.isChecked(),
+            ort_iobinding=self.settings.check_ort_iobinding.isChecked(),
+            ov_requests=int(self.settings.spin_ov_requests.value()),
+            quantize=self.settings.check_quantize.isChecked(),
+            quant_data=self.settings.line_quant_data.text(),
+            compile=self.settings.check_compile.isChecked(),
+            tile=self.settings.check_tile.isChecked(),
+            tta=self.settings.line_tta.text(),
+            tta_pad=self.settings.check_tta_pad.isChecked(),
+            ensemble_mode=self.settings.combo_ensemble.currentText(),
+            ensemble_merge=self.settings.combo_merge.currentText(),
+            nms=self.settings.combo_nms.currentText(),
+            sparse_decode=self.settings.check_sparse.isChecked(),
+            classes=self.settings.line_classes.text(),
+            rect=self.settings.check_rect.isChecked()
         )
         if check:
-            if not self.camera.yolo.load_model():
-                return False
+            with profiler.stage('加载模型'):
+                if not self.camera.yolo.load_model():
+                    YOLOGGER.warning('模型加载失败')
+                    self.update_status('Model loading failed.', False)
+                    self.btn_camera.setEnabled(False)
+                    self.signal_config_error.emit('模型加载失败，详见日志！')
+                    return False
             self.update_status('Model loaded.', True)
             self.btn_camera.setEnabled(True)
             YOLOGGER.info('模型已成功加载')
@@ -191,8 +229,19 @@ class MainWindow(QMainWindow):
         YOLOGGER.info('start update and print fps')
         while self.camera.detecting:
             self.info.update_fps(self.camera.fps)
+            self.info.update_latency(self.camera.latency)
+            if self.camera.scheduler is not None:
+                decision = self.camera.scheduler.describe()
+            else:  # 没有调度器：OpenVINO异步推理或流水线检测
+                decision = 'openvino async' if self.camera.yolo.is_xml else 'pipeline'
+            if self.camera.resolution is not None:
+                decision += f' @{self.camera.resolution.size}'  # 自适应选择的分辨率
+            self.info.update_decision(decision)
+            if self.camera.gate is not None:
+                self.info.update_skipped(self.camera.gate.skipped, self.camera.gate.frames)
             time.sleep(0.2)
         self.info.update_fps(self.camera.fps)
+        self.info.update_latency(self.camera.latency)
         YOLOGGER.info('stop update and print fps')
 
     def resizeEvent(self, event):
@@ -204,8 +253,12 @@ class MainWindow(QMainWindow):
 
 
 def main():
-    app = QApplication(sys.argv)
-    window = MainWindow()
+    profiler.mark('模块导入完成')
+    with profiler.stage('创建QApplication'):
+        app = QApplication(sys.argv)
+    with profiler.stage('创建主窗口'):
+        window = MainWindow()
+    profiler.mark('主窗口显示')
     sys.exit(app.exec_())
 
 
@@ -13,12 +13,8 @@ from pathlib import Path
 
 import cv2
 import numpy as np
-import pandas as pd
-import requests
 import torch
 import torch.nn as nn
-import yaml
-from PIL import Image
 from torch.cuda import amp
 
 from utils.datasets import exif_transpose, letterbox
@@ -298,6 +294,7 @@ class DetectMultiBackend(nn.Module):
         stride, names = 64, [f'class{i}' for i in range(1000)]  # assign defaults
         w = attempt_download(w)  # download if not local
         if data:  # data.yaml path (optional)
+            import yaml  # lazy import
             with open(data, errors='ignore') as f:
                 names = yaml.safe_load(f)['names']  # class names
 
@@ -421,6 +418,7 @@ class DetectMultiBackend(nn.Module):
             self.context.execute_v2(list(self.binding_addrs.values()))
             y = self.bindings['output'].data
         elif self.coreml:  # CoreML
+            from PIL import Image  # lazy import
             im = im.permute(0, 2, 3, 1).cpu().numpy()  # torch BCHW to numpy BHWC shape(1,320,192,3)
             im = Image.fromarray((im[0] * 255).astype('uint8'))
             # im = im.resize((192, 320), Image.ANTIALIAS)
@@ -483,6 +481,7 @@ class AutoShape(nn.Module):
     multi_label = False  # NMS multiple labels per box
     classes = None  # (optional list) filter by class, i.e. = [0, 15, 16] for COCO persons, cats and dogs
     max_det = 1000  # maximum number of detections per image
+    nms = 'greedy'  # NMS engine, greedy, matrix, cluster or soft
     amp = False  # Automatic Mixed Precision (AMP) inference
 
     def __init__(self, model):
@@ -491,6 +490,7 @@ class AutoShape(nn.Module):
         copy_attr(self, model, include=('yaml', 'nc', 'hyp', 'names', 'stride', 'abc'), exclude=())  # copy attributes
         self.dmb = isinstance(model, DetectMultiBackend)  # DetectMultiBackend() instance
         self.pt = not self.dmb or model.pt  # PyTorch model
+        self.raw_input = getattr(model.model if self.dmb and self.pt else model, 'raw_input', False)  # uint8 BGR input
         self.model = model.eval()
 
     def _apply(self, fn):
@@ -523,12 +523,17 @@ class AutoShape(nn.Module):
                 return self.model(imgs.to(p.device).type_as(p), augment, profile)  # inference
 
         # Pre-process
+        from PIL import Image  # lazy import
         n, imgs = (len(imgs), imgs) if isinstance(imgs, list) else (1, [imgs])  # number of images, list of images
         shape0, shape1, files = [], [], []  # image and inference shapes, filenames
         for i, im in enumerate(imgs):
             f = f'image{i}'  # filename
             if isinstance(im, (str, Path)):  # filename or uri
-                im, f = Image.open(requests.get(im, stream=True).raw if str(im).startswith('http') else im), im
+                if str(im).startswith('http'):
+                    import requests  # lazy import, only needed for URL inputs
+                    im, f = Image.open(requests.get(im, stream=True).raw), im
+                else:
+                    im, f = Image.open(im), im
                 im = np.asarray(exif_transpose(im))
             elif isinstance(im, Image.Image):  # PIL Image
                 im, f = np.asarray(exif_transpose(im)), getattr(im, 'filename', f) or f
@@ -544,8 +549,12 @@ class AutoShape(nn.Module):
         shape1 = [make_divisible(x, self.stride) for x in np.stack(shape1, 0).max(0)]  # inference shape
         x = [letterbox(im, new_shape=shape1 if self.pt else size, auto=False)[0] for im in imgs]  # pad
         x = np.stack(x, 0) if n > 1 else x[0][None]  # stack
-        x = np.ascontiguousarray(x.transpose((0, 3, 1, 2)))  # BHWC to BCHW
-        x = torch.from_numpy(x).to(p.device).type_as(p) / 255  # uint8 to fp16/32
+        if self.raw_input:  # RGB to BGR and 0-255 to 0.0-1.0 folded into the first convolution
+            x = np.ascontiguousarray(x[..., ::-1].transpose((0, 3, 1, 2)))  # RGB to BGR, BHWC to BCHW
+            x = torch.from_numpy(x).to(p.device).type_as(p)  # uint8 to fp16/32
+        else:
+            x = np.ascontiguousarray(x.transpose((0, 3, 1, 2)))  # BHWC to BCHW
+            x = torch.from_numpy(x).to(p.device).type_as(p) / 255  # uint8 to fp16/32
         t.append(time_sync())
 
         with amp.autocast(enabled=autocast):
@@ -555,7 +564,8 @@ class AutoShape(nn.Module):
 
             # Post-process
             y = non_max_suppression(y if self.dmb else y[0], self.conf, iou_thres=self.iou, classes=self.classes,
-                                    agnostic=self.agnostic, multi_label=self.multi_label, max_det=self.max_det)  # NMS
+                                    agnostic=self.agnostic, multi_label=self.multi_label, max_det=self.max_det,
+                                    engine=self.nms)  # NMS
             for i in range(n):
                 scale_coords(shape1, y[i][:, :4], shape0[i])
 
@@ -583,6 +593,7 @@ class Detections:
         self.s = shape  # inference BCHW shape
 
     def display(self, pprint=False, show=False, save=False, crop=False, render=False, save_dir=Path('')):
+        from PIL import Image  # lazy import
         crops = []
         for i, (im, pred) in enumerate(zip(self.imgs, self.pred)):
             s = f'image {i + 1}/{len(self.pred)}: {im.shape[0]}x{im.shape[1]} '  # string
@@ -643,6 +654,7 @@ class Detections:
 
     def pandas(self):
         # return detections as pandas DataFrames, i.e. print(results.pandas().xyxy[0])
+        import pandas as pd  # lazy import
         new = copy(self)  # return copy
         ca = 'xmin', 'ymin', 'xmax', 'ymax', 'confidence', 'class', 'name'  # xyxy columns
         cb = 'xcenter', 'ycenter', 'width', 'height', 'confidence', 'class', 'name'  # xywh columns
@@ -2,7 +2,14 @@
 """
 Experimental modules
 """
+import contextlib
+import json
 import math
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from pathlib import Path
 
 import numpy as np
 import torch
@@ -10,6 +17,7 @@ import torch.nn as nn
 
 from models.common import Conv
 from utils.downloads import attempt_download
+from utils.general import LOGGER, check_version, non_max_suppression, weighted_boxes_fusion, xyxy2xywh
 
 
 class CrossConv(nn.Module):
@@ -72,32 +80,194 @@ class MixConv2d(nn.Module):
         return self.act(self.bn(torch.cat([m(x) for m in self.m], 1)))
 
 
+def _ensemble_worker(model, threads, q_in, q_out):
+    # Runs one ensemble member in a separate process, inputs and outputs are passed through shared memory
+    torch.set_num_threads(threads)
+    with torch.no_grad():
+        for args in iter(q_in.get, None):
+            q_out.put(model(*args)[0])
+
+
 class Ensemble(nn.ModuleList):
     # Ensemble of models
+    merge = 'nms'  # merge member outputs by 'nms' (concatenate, NMS by the caller) or 'wbf' (weighted boxes fusion)
+    conf_thres = 0.25  # per-member NMS confidence threshold for 'wbf'
+    iou_thres = 0.45  # per-member NMS and fusion IoU threshold for 'wbf'
+    max_det = 300  # maximum fused detections per image for 'wbf'
+
     def __init__(self):
         super().__init__()
+        self.mode = None  # run members sequentially (None), in threads ('thread') or in processes ('process')
+        self.pool = None  # thread pool
+        self.workers = []  # (process, input queue, output queue)
 
     def forward(self, x, augment=False, profile=False, visualize=False):
-        y = []
-        for module in self:
-            y.append(module(x, augment, profile, visualize)[0])
+        if self.workers:  # processes
+            for _, q_in, _ in self.workers:
+                q_in.put((x, augment))
+            y = [self._receive(p, q_out) for p, _, q_out in self.workers]
+        elif self.pool:  # threads, grad mode is thread local
+            grad = torch.is_grad_enabled()
+
+            def run(module):
+                with torch.set_grad_enabled(grad):
+                    return module(x, augment, profile, visualize)[0]
+
+            y = list(self.pool.map(run, self))
+        else:
+            y = [module(x, augment, profile, visualize)[0] for module in self]
+        if self.merge == 'wbf':
+            return self._fuse(y), None
         # y = torch.stack(y).max(0)[0]  # max ensemble
         # y = torch.stack(y).mean(0)  # mean ensemble
         y = torch.cat(y, 1)  # nms ensemble
         return y, None  # inference, train output
 
+    def _receive(self, p, q_out, timeout=1.0):
+        # Output of a member process, raises instead of blocking forever if the process died (i.e. an import error
+        # under spawn, out of memory or a CUDA error)
+        while True:
+            try:
+                return q_out.get(timeout=timeout)
+            except queue.Empty:
+                if not p.is_alive():
+                    self.close()
+                    raise RuntimeError(f'Ensemble member process {p.pid} exited with code {p.exitcode}')
+
+    def _fuse(self, y):
+        # Weighted boxes fusion of per-member NMS detections, returned in the raw output format (xywh, obj, cls)
+        det = [non_max_suppression(yi, self.conf_thres, self.iou_thres, max_det=self.max_det) for yi in y]
+        det = [weighted_boxes_fusion(d, self.iou_thres, len(y), self.max_det) for d in zip(*det)]  # per image
+        out = y[0].new_zeros((len(det), max(max(len(d) for d in det), 1), y[0].shape[2]))
+        for i, d in enumerate(det):
+            out[i, :len(d), :4] = xyxy2xywh(d[:, :4])
+            out[i, :len(d), 4] = d[:, 4]  # obj conf
+            out[i, range(len(d)), d[:, 5].long() + 5] = 1.0  # cls conf
+        return out
+
+    def parallel(self, mode=None, threads=None):
+        # Run members concurrently, mode='thread', 'process' (CPU only) or None for sequential
+        # threads: intra-op threads per member process, default splits the CPU cores between members
+        self.close()
+        if mode == 'process' and next(self.parameters()).device.type != 'cpu':
+            LOGGER.warning('WARNING: process ensemble is CPU only, running members in threads')
+            mode = 'thread'
+        if mode == 'thread':
+            self.pool = ThreadPoolExecutor(len(self), thread_name_prefix='ensemble')
+        elif mode == 'process':
+            ctx = torch.multiprocessing.get_context('spawn')
+            threads = threads or max((os.cpu_count() or 1) // len(self), 1)
+            for module in self:
+                q_in, q_out = ctx.Queue(), ctx.Queue()
+                p = ctx.Process(target=_ensemble_worker, args=(module, threads, q_in, q_out), daemon=True)
+                p.start()
+                self.workers.append((p, q_in, q_out))
+        self.mode = mode
+        return self
+
+    def close(self):
+        # Stop member threads or processes
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+        for p, q_in, _ in self.workers:
+            if p.is_alive():
+                q_in.put(None)
+                p.join(timeout=10)
+            if p.is_alive():  # stuck in a forward pass
+                p.terminate()
+        self.workers = []
+        self.mode = None
+
+
+def save_mmap(model, f):
+    # Save a fused model as an 8-byte header length, a JSON header (yaml, names, stride, tensor table) and a flat
+    # 64-byte aligned tensor blob that load_mmap() memory-maps, i.e. save_mmap(attempt_load('yolov5s.pt'), 'yolov5s.mmap')
+    model = model.module if hasattr(model, 'module') else model
+    state = {k: v.detach().cpu().contiguous() for k, v in model.state_dict().items()}
+    tensors, offset = [], 0
+    for k, v in state.items():
+        offset = (offset + 63) // 64 * 64  # align
+        tensors.append([k, str(v.numpy().dtype), list(v.shape), offset])
+        offset += v.numel() * v.element_size()
+    header = json.dumps({'yaml': model.yaml, 'names': list(model.names), 'stride': model.stride.tolist(),
+                         'raw_input': bool(model.raw_input), 'tensors': tensors}).encode()
+    with open(f, 'wb') as file:
+        file.write(len(header).to_bytes(8, 'little'))
+        file.write(header)
+        base = (8 + len(header) + 63) // 64 * 64  # blob start
+        for (_, _, _, start), v in zip(tensors, state.values()):
+            file.seek(base + start)
+            file.write(v.numpy().tobytes())
+
+
+def load_mmap_header(f):
+    # JSON header of a file saved by save_mmap() and its length, i.e. load_mmap_header('yolov5s.mmap')[0]['names']
+    with open(f, 'rb') as file:
+        n = int.from_bytes(file.read(8), 'little')  # header length
+        return json.loads(file.read(n)), n
+
+
+def load_mmap(f, map_location=None):
+    # Load a model saved by save_mmap(), parameters are copy-on-write views of the memory-mapped blob shared across
+    # processes, so loading reads no tensor data up front
+    from models.yolo import Model, parse_model
+
+    header, n = load_mmap_header(f)
+    blob = np.memmap(f, dtype=np.uint8, mode='c', offset=(8 + n + 63) // 64 * 64)  # copy-on-write mapping
+    state = {}
+    for k, dtype, shape, start in header['tensors']:
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        state[k] = torch.from_numpy(blob[start:start + nbytes].view(dtype).reshape(shape))
+
+    # Fused architecture only: no Model() init, stride probe, fuse() or info(), stride and tensors come from the file
+    meta = check_version(torch.__version__, '2.1.0')  # empty meta tensors and load_state_dict(assign=True)
+    model = Model.__new__(Model)
+    nn.Module.__init__(model)
+    model.yaml = header['yaml']
+    with torch.device('meta') if meta else contextlib.nullcontext():
+        model.model, model.save = parse_model(deepcopy(model.yaml), ch=[model.yaml['ch']], verbose=False)
+        for m in model.model.modules():
+            if isinstance(m, Conv) and hasattr(m, 'bn'):  # as fused by Model.fuse()
+                m.conv.bias = nn.Parameter(torch.empty(m.conv.out_channels))
+                delattr(m, 'bn')
+                m.forward = m.forward_fuse
+    if meta:
+        model.load_state_dict(state, assign=True)
+    else:
+        tensors = {**dict(model.named_parameters()), **dict(model.named_buffers())}
+        for k, v in state.items():
+            tensors[k].data = v
+    model.eval().requires_grad_(False)
+    m = model.model[-1]  # Detect()
+    m.grid, m.anchor_grid = [torch.zeros(1)] * m.nl, [torch.zeros(1)] * m.nl  # replace meta placeholders
+    model.inplace = m.inplace = model.yaml.get('inplace', True)
+    model.stride = m.stride = torch.tensor(header['stride'])
+    model.names = header['names']
+    if header['raw_input']:
+        model.raw_input = True
+    return model.to(map_location) if map_location else model
+
 
-def attempt_load(weights, map_location=None, inplace=True, fuse=True):
+def attempt_load(weights, map_location=None, inplace=True, fuse=True, raw_input=False):
     from models.yolo import Detect, Model
 
     # Loads an ensemble of models weights=[a,b,c] or a single model weights=[a] or weights=a
+    # raw_input=True folds BGR to RGB and 0-255 to 0.0-1.0 into the first convolution (uint8 BGR inputs)
     model = Ensemble()
     for w in weights if isinstance(weights, list) else [weights]:
+        if Path(w).suffix == '.mmap':  # fused FP32 model saved by save_mmap()
+            model.append(load_mmap(w, map_location))
+            if raw_input:
+                model[-1].fold_input()
+            continue
         ckpt = torch.load(attempt_download(w), map_location=map_location)  # load
         if fuse:
             model.append(ckpt['ema' if ckpt.get('ema') else 'model'].float().fuse().eval())  # FP32 model
         else:
             model.append(ckpt['ema' if ckpt.get('ema') else 'model'].float().eval())  # without layer fuse
+        if raw_input:
+            model[-1].fold_input()
 
     # Compatibility updates
     for m in model.modules():
@@ -114,7 +284,7 @@ def attempt_load(weights, map_location=None, inplace=True, fuse=True):
         return model[-1]  # return model
     else:
         print(f'Ensemble created with {weights}\n')
-        for k in ['names']:
+        for k in ['names', 'raw_input']:
             setattr(model, k, getattr(model[-1], k))
         model.stride = model[torch.argmax(torch.tensor([m.stride.max() for m in model])).int()].stride  # max stride
         return model  # return ensemble
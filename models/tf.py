@@ -31,7 +31,7 @@ from models.common import C3, SPP, SPPF, Bottleneck, BottleneckCSP, Concat, Conv
 from models.experimental import CrossConv, MixConv2d, attempt_load
 from models.yolo import Detect
 from utils.activations import SiLU
-from utils.general import LOGGER, make_divisible, print_args
+from utils.general import LOGGER, GridCache, make_divisible, print_args
 
 
 class TFBN(keras.layers.Layer):
@@ -196,6 +196,9 @@ class TFSPPF(keras.layers.Layer):
         return self.cv2(tf.concat([x, y1, y2, self.m(y2)], 3))
 
 
+TF_GRIDS = GridCache()  # grids shared by the TFDetect() layers of all TF models built in this process
+
+
 class TFDetect(keras.layers.Layer):
     def __init__(self, nc=80, anchors=(), ch=(), imgsz=(640, 640), w=None):  # detection layer
         super().__init__()
@@ -213,7 +216,7 @@ class TFDetect(keras.layers.Layer):
         self.imgsz = imgsz
         for i in range(self.nl):
             ny, nx = self.imgsz[0] // self.stride[i], self.imgsz[1] // self.stride[i]
-            self.grid[i] = self._make_grid(nx, ny)
+            self.grid[i] = TF_GRIDS.get((i, int(ny), int(nx), 'tf', 'float32'), lambda: self._make_grid(nx, ny))
 
     def call(self, inputs):
         z = []  # inference output
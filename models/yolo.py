@@ -7,6 +7,7 @@ Usage:
 """
 
 import argparse
+import math
 import sys
 from copy import deepcopy
 from pathlib import Path
@@ -20,7 +21,7 @@ if str(ROOT) not in sys.path:
 from models.common import *
 from models.experimental import *
 from utils.autoanchor import check_anchor_order
-from utils.general import LOGGER, check_version, check_yaml, make_divisible, print_args
+from utils.general import LOGGER, GridCache, check_version, check_yaml, make_divisible, print_args
 from utils.plots import feature_visualization
 from utils.torch_utils import fuse_conv_and_bn, initialize_weights, model_info, scale_img, select_device, time_sync
 
@@ -33,6 +34,8 @@ except ImportError:
 class Detect(nn.Module):
     stride = None  # strides computed during build
     onnx_dynamic = False  # ONNX export parameter
+    conf_thres = 0  # threshold-first decode: only decode anchors with objectness above this (0 to decode all)
+    grid_cache_size = 32  # grids kept per Detect() for changing input shapes, least recently used are evicted
 
     def __init__(self, nc=80, anchors=(), ch=(), inplace=True):  # detection layer
         super().__init__()
@@ -47,6 +50,8 @@ class Detect(nn.Module):
         self.inplace = inplace  # use in-place ops (e.g. slice assignment)
 
     def forward(self, x):
+        if self.conf_thres and not self.training and not torch.jit.is_tracing():
+            return self._forward_sparse(x)
         z = []  # inference output
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
@@ -54,8 +59,12 @@ class Detect(nn.Module):
             x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2).contiguous()
 
             if not self.training:  # inference
-                if self.onnx_dynamic or self.grid[i].shape[2:4] != x[i].shape[2:4]:
+                if self.onnx_dynamic or torch.jit.is_tracing():  # bypass the cache, grids are built inside the trace
                     self.grid[i], self.anchor_grid[i] = self._make_grid(nx, ny, i)
+                elif self.grid[i].shape[2:4] != x[i].shape[2:4] or \
+                        (self.grid[i].device, self.grid[i].dtype) != (x[i].device, x[i].dtype):
+                    self.grid[i], self.anchor_grid[i] = self.grids.get(
+                        (i, ny, nx, x[i].device, x[i].dtype), lambda: self._make_grid(nx, ny, i, x[i].dtype))
 
                 y = x[i].sigmoid()
                 if self.inplace:
@@ -69,19 +78,55 @@ class Detect(nn.Module):
 
         return x if self.training else (torch.cat(z, 1), x)
 
-    def _make_grid(self, nx=20, ny=20, i=0):
+    def _forward_sparse(self, x):
+        # Threshold-first inference, objectness is thresholded in logit space and only the surviving anchors are
+        # decoded. Output is (bs, n, no) with n the max number of candidates per image, padded with zero objectness
+        t = math.log(self.conf_thres / (1 - self.conf_thres))  # objectness logit threshold
+        z, b = [], []  # candidates, image index
+        for i in range(self.nl):
+            x[i] = self.m[i](x[i])  # conv
+            bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85), a view without copy
+            x[i] = x[i].view(bs, self.na, self.no, ny, nx).permute(0, 1, 3, 4, 2)
+            bi, a, gy, gx = (x[i][..., 4] > t).nonzero(as_tuple=True)
+            y = x[i][bi, a, gy, gx].sigmoid()  # (n,85)
+            xy = (y[:, 0:2] * 2 - 0.5 + torch.stack((gx, gy), 1).to(y.dtype)) * self.stride[i]  # xy
+            wh = (y[:, 2:4] * 2) ** 2 * self.anchors[i][a] * self.stride[i]  # wh
+            z.append(torch.cat((xy, wh, y[:, 4:]), 1))
+            b.append(bi)
+        z, b = torch.cat(z, 0), torch.cat(b, 0)
+
+        # Scatter candidates into their images
+        n = torch.bincount(b, minlength=bs)
+        i = b.argsort()  # group by image
+        j = torch.arange(len(b), device=b.device) - (n.cumsum(0) - n)[b[i]]  # index within image
+        y = z.new_zeros((bs, int(n.max()), self.no))
+        y[b[i], j] = z[i]
+        return y, x
+
+    @property
+    def grids(self):  # per-shape grid cache, created on first use (also for Detect() layers of older checkpoints)
+        if 'grid_cache' not in self.__dict__:
+            self.grid_cache = GridCache(self.grid_cache_size)
+        return self.grid_cache
+
+    def _make_grid(self, nx=20, ny=20, i=0, dtype=torch.float32):
         d = self.anchors[i].device
         if check_version(torch.__version__, '1.10.0'):  # torch>=1.10.0 meshgrid workaround for torch>=0.7 compatibility
             yv, xv = torch.meshgrid([torch.arange(ny, device=d), torch.arange(nx, device=d)], indexing='ij')
         else:
             yv, xv = torch.meshgrid([torch.arange(ny, device=d), torch.arange(nx, device=d)])
-        grid = torch.stack((xv, yv), 2).expand((1, self.na, ny, nx, 2)).float()
+        grid = torch.stack((xv, yv), 2).expand((1, self.na, ny, nx, 2)).to(dtype)
         anchor_grid = (self.anchors[i].clone() * self.stride[i]) \
-            .view((1, self.na, 1, 1, 2)).expand((1, self.na, ny, nx, 2)).float()
+            .view((1, self.na, 1, 1, 2)).expand((1, self.na, ny, nx, 2)).to(dtype)
         return grid, anchor_grid
 
 
 class Model(nn.Module):
+    raw_input = False  # BGR to RGB and 0-255 to 0.0-1.0 folded into the first convolution
+    tta_scales = (1, 0.83, 0.67)  # augmented inference scales
+    tta_flips = (None, 3, None)  # augmented inference flips (2-ud, 3-lr)
+    tta_pad = False  # pad augmented variants to a common shape and run them in a single batch
+
     def __init__(self, cfg='yolov5s.yaml', ch=3, nc=None, anchors=None):  # model, input channels, number of classes
         super().__init__()
         if isinstance(cfg, dict):
@@ -126,17 +171,31 @@ class Model(nn.Module):
         return self._forward_once(x, profile, visualize)  # single-scale inference, train
 
     def _forward_augment(self, x):
+        m = self.model[-1]  # Detect()
+        conf_thres, m.conf_thres = m.conf_thres, 0  # tail clipping needs the dense output
+        try:
+            return self._forward_augment_dense(x)
+        finally:
+            m.conf_thres = conf_thres
+
+    def _forward_augment_dense(self, x):
         img_size = x.shape[-2:]  # height, width
-        s = [1, 0.83, 0.67]  # scales
-        f = [None, 3, None]  # flips (2-ud, 3-lr)
-        y = []  # outputs
-        for si, fi in zip(s, f):
-            xi = scale_img(x.flip(fi) if fi else x, si, gs=int(self.stride.max()))
-            yi = self._forward_once(xi)[0]  # forward
-            # cv2.imwrite(f'img_{si}.jpg', 255 * xi[0].cpu().numpy().transpose((1, 2, 0))[:, :, ::-1])  # save
-            yi = self._descale_pred(yi, fi, si, img_size)
-            y.append(yi)
-        y = self._clip_augmented(y)  # clip augmented tails
+        s, f = self.tta_scales, self.tta_flips  # scales, flips (2-ud, 3-lr)
+        gs, value = int(self.stride.max()), 114 if self.raw_input else 0.447
+        xs = [scale_img(x.flip(fi) if fi else x, si, gs=gs, value=value) for si, fi in zip(s, f)]
+        if self.tta_pad:  # pad all variants to a common shape, one forward pass
+            h, w = max(xi.shape[2] for xi in xs), max(xi.shape[3] for xi in xs)
+            xs = [nn.functional.pad(xi, [0, w - xi.shape[3], 0, h - xi.shape[2]], value=value) for xi in xs]
+        groups = {}  # variants sharing a padded shape are stacked into one batch
+        for i, xi in enumerate(xs):
+            groups.setdefault(xi.shape[2:], []).append(i)
+        y = [None] * len(xs)  # outputs
+        for idx in groups.values():
+            yi = self._forward_once(torch.cat([xs[i] for i in idx]))[0]  # forward
+            for i, yj in zip(idx, yi.split(x.shape[0])):
+                y[i] = self._descale_pred(yj, f[i], s[i], img_size)
+        if max(s) > min(s):
+            y = self._clip_augmented([y[i] for i in sorted(range(len(y)), key=lambda i: -s[i])])  # clip augmented tails
         return torch.cat(y, 1), None  # augmented inference, train
 
     def _forward_once(self, x, profile=False, visualize=False):
@@ -225,6 +284,31 @@ class Model(nn.Module):
         self.info()
         return self
 
+    def fold_input(self):  # fold BGR to RGB and 0-255 to 0.0-1.0 into the first convolution, model then takes raw BGR
+        if not self.raw_input:
+            LOGGER.info('Folding input normalization... ')
+            conv = next(m for m in self.model.modules() if isinstance(m, nn.Conv2d))  # first convolution
+            w = conv.weight.data  # input channels in BGR/RGB triplets, i.e. 3 for Conv() or 12 for Focus()
+            c2, c1 = w.shape[:2]
+            conv.weight.data = w.view(c2, c1 // 3, 3, *w.shape[2:]).flip(2).reshape(w.shape) / 255  # RGB to BGR, /255
+            self.raw_input = True
+        return self
+
+    def prune_classes(self, classes):  # keep only the Detect() outputs of classes, class i of the result is classes[i]
+        m = self.model[-1]  # Detect()
+        LOGGER.info(f'Pruning Detect() to {len(classes)}/{m.nc} classes... ')
+        keep = torch.tensor(list(range(5)) + [5 + c for c in classes])  # box, obj and kept class outputs per anchor
+        keep = (keep[None] + torch.arange(m.na)[:, None] * m.no).view(-1)  # over all anchors
+        for i, conv in enumerate(m.m):
+            pruned = nn.Conv2d(conv.in_channels, len(keep), 1).to(conv.weight.device, conv.weight.dtype)
+            pruned.weight.data = conv.weight.data[keep.to(conv.weight.device)].clone()
+            pruned.bias.data = conv.bias.data[keep.to(conv.weight.device)].clone()
+            m.m[i] = pruned.requires_grad_(conv.weight.requires_grad)
+        m.nc, m.no = len(classes), len(classes) + 5
+        self.yaml = {**self.yaml, 'nc': len(classes)}  # rebuilds (i.e. load_mmap()) with the pruned head
+        self.names = [self.names[c] for c in classes]
+        return self
+
     def info(self, verbose=False, img_size=640):  # print model information
         model_info(self, verbose, img_size)
 
@@ -234,14 +318,16 @@ class Model(nn.Module):
         m = self.model[-1]  # Detect()
         if isinstance(m, Detect):
             m.stride = fn(m.stride)
+            m.grids.clear()  # rebuilt on the new device / dtype
             m.grid = list(map(fn, m.grid))
             if isinstance(m.anchor_grid, list):
                 m.anchor_grid = list(map(fn, m.anchor_grid))
         return self
 
 
-def parse_model(d, ch):  # model_dict, input_channels(3)
-    LOGGER.info(f"\n{'':>3}{'from':>18}{'n':>3}{'params':>10}  {'module':<40}{'arguments':<30}")
+def parse_model(d, ch, verbose=True):  # model_dict, input_channels(3), print layers
+    if verbose:
+        LOGGER.info(f"\n{'':>3}{'from':>18}{'n':>3}{'params':>10}  {'module':<40}{'arguments':<30}")
     anchors, nc, gd, gw = d['anchors'], d['nc'], d['depth_multiple'], d['width_multiple']
     na = (len(anchors[0]) // 2) if isinstance(anchors, list) else anchors  # number of anchors
     no = na * (nc + 5)  # number of outputs = anchors * (classes + 5)
@@ -285,7 +371,8 @@ def parse_model(d, ch):  # model_dict, input_channels(3)
         t = str(m)[8:-2].replace('__main__.', '')  # module type
         np = sum(x.numel() for x in m_.parameters())  # number params
         m_.i, m_.f, m_.type, m_.np = i, f, t, np  # attach index, 'from' index, type, number params
-        LOGGER.info(f'{i:>3}{str(f):>18}{n_:>3}{np:10.0f}  {t:<40}{str(args):<30}')  # print
+        if verbose:
+            LOGGER.info(f'{i:>3}{str(f):>18}{n_:>3}{np:10.0f}  {t:<40}{str(args):<30}')  # print
         save.extend(x % i for x in ([f] if isinstance(f, int) else f) if x != -1)  # append to savelist
         layers.append(m_)
         if i == 0:
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+Desc:
+    三级流水线检测：预处理、推理、后处理(NMS及结果转换)分别在独立线程中执行，
+    各级之间用有界队列连接，第N帧推理的同时预处理第N+1帧、后处理第N-1帧
+"""
+
+import threading
+import time
+from queue import Empty, Full, Queue
+
+import torch
+
+from gb import YOLOGGER
+
+
+class DetectPipeline:
+    """流水线检测器
+
+    put()送入图像，get()按送入顺序取出(图像, 检测结果)，队列满时put()阻塞，
+    fps为流水线吞吐量(每秒输出的帧数)，latency为单帧从送入到输出的端到端延迟
+    """
+
+    def __init__(self, yolo, depth=2):
+        self.yolo = yolo
+        self.depth = depth  # 每级队列的最大长度
+        self.queues = []  # 输入 -> 预处理 -> 推理 -> 后处理 -> 输出，共4个队列
+        self.threads = []
+        self.running = False
+
+        self.fps = 0  # 吞吐量
+        self.latency = 0  # 端到端延迟(s)
+        self.t_last = 0  # 上一次输出结果的时间
+
+    def start(self):
+        self.stop()
+        self.queues = [Queue(self.depth) for _ in range(4)]
+        self.fps = self.latency = self.t_last = 0
+        self.running = True
+        stages = [self.preprocess, self.inference, self.postprocess]
+        self.threads = [threading.Thread(target=self.run_stage, args=(f, *self.queues[i:i + 2]), daemon=True)
+                        for i, f in enumerate(stages)]
+        for t in self.threads:
+            t.start()
+        YOLOGGER.info('流水线检测线程开始')
+
+    def stop(self):
+        """停止各级线程并丢弃未完成的帧"""
+        if not self.running:
+            return
+        self.running = False
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        YOLOGGER.info('流水线检测线程结束')
+
+    def put(self, image, timeout=None, t0=None):
+        """送入一帧图像，队列已满时最多阻塞timeout秒，送入成功返回True，t0为计算延迟的起始时刻(默认为送入时刻)"""
+        try:
+            self.queues[0].put((t0 or time.time(), image), timeout=timeout)
+            return True
+        except Full:
+            return False
+
+    def get(self, timeout=None):
+        """取出最早送入的一帧的(图像, 检测结果)，超时返回None"""
+        try:
+            t0, image, objects = self.queues[-1].get(timeout=timeout)
+        except Empty:
+            return None
+        t = time.time()
+        if self.t_last:
+            dt = max(t - self.t_last, 1e-6)  # 相邻两帧输出的间隔
+            self.fps = 0.9 * self.fps + 0.1 / dt if self.fps else 1 / dt
+        self.latency = 0.9 * self.latency + 0.1 * (t - t0) if self.latency else t - t0
+        self.t_last = t
+        return image, objects
+
+    def run_stage(self, func, q_in, q_out):
+        """从q_in取出数据处理后放入q_out，周期性检查是否停止"""
+        with torch.no_grad():  # no_grad只对当前线程生效
+            while self.running:
+                try:
+                    t0, image, *data = q_in.get(timeout=0.1)
+                except Empty:
+                    continue
+                try:
+                    item = (t0, image, func(image, *data))
+                except Exception as e:
+                    YOLOGGER.error(f'流水线检测出错: {e}')
+                    continue
+                while self.running:
+                    try:
+                        q_out.put(item, timeout=0.1)
+                        break
+                    except Full:
+                        continue
+
+    def preprocess(self, image):
+        tiles = self.yolo.tile(image) if self.yolo.opt.get('tile') else None  # 切分图块
+        img = self.yolo.preprocess(tiles[0] if tiles else [image])
+        # 复用的输入缓冲区会在下一帧预处理时被覆盖，而此时本帧可能还在等待推理
+        return img.clone() if self.yolo.buffer is not None else img, tiles
+
+    def inference(self, image, data):
+        img, tiles = data
+        pred = self.yolo.inference(img)
+        # ONNX Runtime IOBinding的输出缓冲区会在下一次推理时被覆盖，而此时本帧可能还在后处理
+        return pred.clone() if self.yolo.io_binding is not None else pred, img.shape[2:], tiles
+
+    def postprocess(self, image, data):
+        pred, shape, tiles = data
+        if tiles:
+            return self.yolo.merge_tiles(pred, shape, *tiles, image)
+        return self.yolo.postprocess(pred, shape, [image])[0]
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+"""
+Desc:
+    启动耗时分析(python main.py --profile-startup)
+    记录每个模块的导入耗时(总耗时/除去子模块的自身耗时)以及各初始化阶段的耗时，
+    在首帧检测完成后输出到日志，用于排查启动阶段被不必要导入拖慢的问题
+"""
+
+import builtins
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+ENABLED = False
+T0 = time.perf_counter()  # 进程启动(本模块导入)时刻
+
+_import = builtins.__import__
+_local = threading.local()  # 每个线程独立的导入栈
+_lock = threading.Lock()
+_imports = []  # (模块名, 总耗时, 自身耗时, 线程名)
+_stages = []  # (阶段名, 开始时刻, 耗时)
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """替换builtins.__import__，仅统计首次导入(不在sys.modules中)的绝对导入"""
+    if level or name in sys.modules:
+        return _import(name, globals, locals, fromlist, level)
+    stack = _local.__dict__.setdefault('stack', [])
+    stack.append(0.0)  # 子模块耗时累计
+    t = time.perf_counter()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        total = time.perf_counter() - t
+        children = stack.pop()
+        if stack:
+            stack[-1] += total
+        with _lock:
+            _imports.append((name, total, total - children, threading.current_thread().name))
+
+
+def enable():
+    """开始统计，需在导入其他模块之前调用"""
+    global ENABLED
+    ENABLED = True
+    builtins.__import__ = _timed_import
+
+
+@contextmanager
+def stage(name):
+    """统计一个初始化阶段的耗时"""
+    if not ENABLED:
+        yield
+        return
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _lock:
+            _stages.append((name, t - T0, time.perf_counter() - t))
+
+
+def mark(name):
+    """记录某一时刻(距启动的时间)"""
+    if ENABLED:
+        with _lock:
+            _stages.append((name, time.perf_counter() - T0, 0.0))
+
+
+def report(top=25):
+    """输出统计结果并停止统计"""
+    global ENABLED
+    if not ENABLED:
+        return
+    ENABLED = False
+    builtins.__import__ = _import  # 停止统计
+
+    from gb import YOLOGGER
+
+    with _lock:
+        imports = sorted(_imports, key=lambda x: x[1], reverse=True)[:top]
+        stages = sorted(_stages, key=lambda x: x[1])
+    lines = [f'启动耗时分析 (共{time.perf_counter() - T0:.3f}s)',
+             f'{"模块":<40}{"总耗时(s)":>12}{"自身耗时(s)":>14}  线程']
+    lines += [f'{name:<40}{total:>12.3f}{own:>14.3f}  {thread}' for name, total, own, thread in imports]
+    lines += [f'{"阶段":<40}{"开始(s)":>12}{"耗时(s)":>14}']
+    lines += [f'{name:<40}{start:>12.3f}{dt:>14.3f}' for name, start, dt in stages]
+    YOLOGGER.info('\n'.join(lines))
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+Desc:
+    检测调度：逐帧决定是否检测以及使用哪种检测配置
+"""
+
+import math
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+
+class FrameScheduler:
+    """自适应跳帧控制器
+
+    用检测耗时的指数滑动平均估计本帧检测完成时的延迟(从采集到检测完成)，在预算内则正常检测，
+    超出预算时改用降级配置(更小的img_size、不使用TTA)，降级后仍超出、但换一帧更新的画面能满足预算时跳过本帧
+    """
+    DETECT = 'detect'
+    DEGRADE = 'degrade'
+    SKIP = 'skip'
+
+    def __init__(self, budget, img_size, augment=False, resizable=True, stride=32, alpha=0.2, max_skip=10, probe=50):
+        self.budget = budget  # 延迟预算(s)，0表示不限制
+        self.img_size = img_size
+        self.augment = augment
+        # 降级配置：输入尺寸减半(需支持改变输入尺寸)，不使用TTA
+        self.small_size = max(math.ceil(img_size / 2 / stride) * stride, stride) if resizable else img_size
+        self.can_degrade = self.small_size < img_size or augment
+        self.alpha = alpha  # 滑动平均系数
+        self.max_skip = max_skip  # 最多连续跳过的帧数，避免画面长时间没有检测结果
+        self.probe = probe  # 降级或跳过一段时间后重新尝试正常检测，以更新其耗时
+        self.cost = {self.DETECT: 0, self.DEGRADE: 0}  # 两种配置的检测耗时(s)，0表示还未测量
+        self.count = {self.DETECT: 0, self.DEGRADE: 0, self.SKIP: 0}  # 各决策的累计次数
+        self.skipped = 0  # 连续跳过的帧数
+        self.since_detect = 0  # 距上一次正常检测的帧数
+        self.decision = self.DETECT  # 最近一次的决策
+
+    def estimate(self, decision):
+        """估计检测耗时，降级配置还未测量时按输入面积估算"""
+        if decision == self.DEGRADE and not self.cost[self.DEGRADE]:
+            return self.cost[self.DETECT] * (self.small_size / self.img_size) ** 2
+        return self.cost[decision]
+
+    def decide(self, timestamp):
+        """根据帧的采集时刻决定本帧的处理方式"""
+        if not self.budget or not self.cost[self.DETECT] or self.since_detect >= self.probe:
+            decision = self.DETECT
+        else:
+            age = time.time() - timestamp  # 帧已等待的时间
+            full, small = self.estimate(self.DETECT), self.estimate(self.DEGRADE)
+            cheapest = min(full, small) if self.can_degrade else full
+            if age + full <= self.budget:
+                decision = self.DETECT
+            elif self.can_degrade and age + small <= self.budget:
+                decision = self.DEGRADE
+            elif cheapest <= self.budget and self.skipped < self.max_skip:  # 更新的帧可以满足预算
+                decision = self.SKIP
+            else:  # 无法满足预算时尽力而为
+                decision = self.DEGRADE if self.can_degrade and small < full else self.DETECT
+        self.skipped = self.skipped + 1 if decision == self.SKIP else 0
+        self.since_detect = 0 if decision == self.DETECT else self.since_detect + 1
+        self.count[decision] += 1
+        self.decision = decision
+        return decision
+
+    def options(self, decision):
+        """决策对应的YOLO5.obj_detect参数"""
+        return dict(img_size=self.small_size, augment=False) if decision == self.DEGRADE else dict()
+
+    def update(self, decision, dt):
+        """记录一次检测的耗时"""
+        cost = self.cost[decision]
+        self.cost[decision] = dt if not cost else (1 - self.alpha) * cost + self.alpha * dt
+
+    def describe(self):
+        """当前决策的说明文字"""
+        if self.decision == self.DEGRADE:
+            return f'{self.decision} ({self.small_size})'
+        if self.decision == self.DETECT:
+            return f'{self.decision} ({self.img_size})'
+        return f'{self.decision} ({self.count[self.SKIP]})'
+
+
+class MotionGate:
+    """运动门控：在缩小的灰度图上与上一次检测的帧做差分，画面没有变化时复用上一次的检测结果
+
+    与上一次检测的帧(而不是上一帧)比较，缓慢的变化累积到一定程度也会触发检测
+    """
+
+    def __init__(self, sensitivity=0.5, size=64, noise=12, max_reuse=300):
+        self.sensitivity = sensitivity  # 灵敏度0~1，越大越容易判定为有变化
+        self.area = 0.02 * (1 - sensitivity)  # 变化像素占比超过该值判定为有变化
+        self.size = size  # 缩小后的宽度
+        self.noise = noise  # 灰度差不超过该值的像素视为噪声
+        self.max_reuse = max_reuse  # 最多连续复用的帧数，超过后强制检测一次
+        self.reference = None  # 上一次检测的帧(缩小的灰度图)
+        self.reused = 0  # 连续复用的帧数
+        self.frames = 0  # 经过门控的总帧数
+        self.skipped = 0  # 复用检测结果而跳过推理的总帧数
+
+    def changed(self, image):
+        """画面相对上一次检测的帧有变化(需要检测)时返回True"""
+        h, w = image.shape[:2]
+        small = cv2.resize(image, (self.size, max(round(self.size * h / w), 1)), interpolation=cv2.INTER_AREA)
+        gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (3, 3), 0)
+        self.frames += 1
+        if self.reference is None or gray.shape != self.reference.shape or self.reused >= self.max_reuse:
+            changed = True
+        else:
+            diff = cv2.absdiff(gray, self.reference)
+            changed = np.count_nonzero(diff > self.noise) > self.area * diff.size
+        if changed:
+            self.reference = gray
+            self.reused = 0
+        else:
+            self.reused += 1
+            self.skipped += 1
+        return changed
+
+
+class ResolutionController:
+    """按最近检测到的目标尺寸逐帧选择推理分辨率
+
+    目标都很大时降低分辨率，出现小目标时恢复；低分辨率下可能漏检小目标，因此定期用最大分辨率探测一次
+    """
+
+    def __init__(self, img_size, stride=32, min_side=24, history=10, probe=15):
+        # 候选分辨率：不超过配置的img_size且为stride的整数倍
+        self.sizes = sorted({math.ceil(s / stride) * stride for s in (320, 416, 512, 640, 768, 1024, 1280)
+                             if s < img_size} | {img_size})
+        self.min_side = min_side  # 目标在推理输入中的最短边不小于该值(像素)才能可靠检测
+        self.history = deque(maxlen=history)  # 最近各检测帧中最小目标的相对尺寸(最短边/图像长边)
+        self.probe = probe  # 每隔多少帧用最大分辨率探测一次
+        self.frames = 0
+        self.size = img_size  # 当前分辨率
+
+    def select(self):
+        """选择本帧的推理分辨率"""
+        self.frames += 1
+        found = [x for x in self.history if x is not None]
+        if not found or self.frames % self.probe == 0:  # 没有目标或定期探测时使用最大分辨率
+            self.size = self.sizes[-1]
+        else:
+            smallest = min(found)
+            self.size = next((s for s in self.sizes if smallest * s >= self.min_side), self.sizes[-1])
+        return self.size
+
+    def update(self, objects, shape):
+        """记录一帧的检测结果，shape为原图尺寸(h, w)"""
+        if not len(objects):
+            self.history.append(None)
+            return
+        h, w = shape[:2]
+        sides = np.minimum(objects.xywh[:, 2] * w, objects.xywh[:, 3] * h) / max(h, w)
+        self.history.append(float(sides.min()))
@@ -14,6 +14,8 @@ from PySide2.QtWidgets import (QDialog, QGridLayout, QCheckBox, QLabel, QLineEdi
                                QListView, QDoubleSpinBox, QVBoxLayout, QHBoxLayout, QFileDialog)
 
 import gb
+import msg_box
+from yolo import parse_tta, tta_cost
 
 
 class SettingsDialog(QDialog):
@@ -31,6 +33,7 @@ class SettingsDialog(QDialog):
         # 选择权重文件
         label_weights = QLabel('Weights')
         self.line_weights = QLineEdit()
+        self.line_weights.setToolTip('Weights file, separate several PyTorch weights with ";" for an ensemble')
         self.line_weights.setFixedHeight(HEIGHT)
 
         self.btn_weights = QPushButton('...')
@@ -62,9 +65,13 @@ class SettingsDialog(QDialog):
         self.combo_size.setView(QListView())
         self.combo_size.addItem('320', 320)
         self.combo_size.addItem('384', 384)
+        self.combo_size.addItem('416', 416)
         self.combo_size.addItem('448', 448)
+        self.combo_size.addItem('480', 480)
         self.combo_size.addItem('512', 512)
+        self.combo_size.addItem('544', 544)
         self.combo_size.addItem('576', 576)
+        self.combo_size.addItem('608', 608)
         self.combo_size.addItem('640', 640)
 
         grid.addWidget(label_size, 4, 0)
@@ -126,7 +133,215 @@ class SettingsDialog(QDialog):
         self.check_dnn = QCheckBox('DNN')
         self.check_dnn.setToolTip('Use OpenCV DNN for ONNX inference')
 
+        # reuse preallocated input buffers
+        self.check_buffer = QCheckBox('Reuse buffer')
+        self.check_buffer.setToolTip('Reuse preallocated input buffers for preprocessing')
+
+        # fold BGR to RGB and 1/255 into the first convolution
+        self.check_raw = QCheckBox('Raw input')
+        self.check_raw.setToolTip('Fold BGR to RGB and 1/255 into the first convolution (PyTorch only)')
+
         grid.addWidget(self.check_dnn, 9, 0)
+        grid.addWidget(self.check_buffer, 9, 1)
+        # trace, freeze and cache a TorchScript model
+        self.check_compile = QCheckBox('Compile')
+        self.check_compile.setToolTip('Trace, freeze and cache a TorchScript model for the configured input')
+
+        grid.addWidget(self.check_raw, 9, 2)
+        grid.addWidget(self.check_compile, 9, 3)
+
+        # ONNX Runtime intra-op/inter-op threads
+        label_ort_threads = QLabel('ORT threads')
+        self.spin_ort_intra = QDoubleSpinBox()
+        self.spin_ort_intra.setToolTip('ONNX Runtime intra-op threads, 0 for default')
+        self.spin_ort_intra.setFixedHeight(HEIGHT)
+        self.spin_ort_intra.setDecimals(0)
+        self.spin_ort_intra.setRange(0, 64)
+        self.spin_ort_inter = QDoubleSpinBox()
+        self.spin_ort_inter.setToolTip('ONNX Runtime inter-op threads, 0 for default')
+        self.spin_ort_inter.setFixedHeight(HEIGHT)
+        self.spin_ort_inter.setDecimals(0)
+        self.spin_ort_inter.setRange(0, 64)
+
+        grid.addWidget(label_ort_threads, 10, 0)
+        grid.addWidget(self.spin_ort_intra, 10, 1)
+        grid.addWidget(self.spin_ort_inter, 10, 2, 1, 2)
+
+        # ONNX Runtime execution mode and graph optimization level
+        label_ort_mode = QLabel('ORT mode')
+        self.combo_ort_mode = QComboBox()
+        self.combo_ort_mode.setToolTip('ONNX Runtime execution mode')
+        self.combo_ort_mode.setFixedHeight(HEIGHT)
+        self.combo_ort_mode.setView(QListView())
+        self.combo_ort_mode.addItem('sequential')
+        self.combo_ort_mode.addItem('parallel')
+        self.combo_ort_level = QComboBox()
+        self.combo_ort_level.setToolTip('ONNX Runtime graph optimization level')
+        self.combo_ort_level.setFixedHeight(HEIGHT)
+        self.combo_ort_level.setView(QListView())
+        for level in ('disable', 'basic', 'extended', 'all'):
+            self.combo_ort_level.addItem(level)
+
+        grid.addWidget(label_ort_mode, 11, 0)
+        grid.addWidget(self.combo_ort_mode, 11, 1)
+        grid.addWidget(self.combo_ort_level, 11, 2, 1, 2)
+
+        # ONNX Runtime IOBinding and optimized model cache
+        self.check_ort_iobinding = QCheckBox('IOBinding')
+        self.check_ort_iobinding.setToolTip('ONNX Runtime IOBinding with preallocated outputs')
+        self.check_ort_save = QCheckBox('Save optimized')
+        self.check_ort_save.setToolTip('Save the optimized ONNX graph next to the weights and reuse it')
+
+        grid.addWidget(self.check_ort_iobinding, 12, 0)
+        grid.addWidget(self.check_ort_save, 12, 1)
+
+        # OpenVINO async infer requests
+        label_ov_requests = QLabel('OV requests')
+        self.spin_ov_requests = QDoubleSpinBox()
+        self.spin_ov_requests.setToolTip('Number of OpenVINO async infer requests')
+        self.spin_ov_requests.setFixedHeight(HEIGHT)
+        self.spin_ov_requests.setDecimals(0)
+        self.spin_ov_requests.setRange(1, 16)
+
+        grid.addWidget(label_ov_requests, 13, 0)
+        grid.addWidget(self.spin_ov_requests, 13, 1, 1, 3)
+
+        # static INT8 quantization and calibration images
+        self.check_quantize = QCheckBox('INT8')
+        self.check_quantize.setToolTip('Static INT8 post-training quantization for PyTorch CPU inference')
+        self.line_quant_data = QLineEdit()
+        self.line_quant_data.setToolTip('Calibration images folder')
+        self.line_quant_data.setPlaceholderText('calibration images folder')
+        self.line_quant_data.setFixedHeight(HEIGHT)
+
+        self.btn_quant_data = QPushButton('...')
+        self.btn_quant_data.setFixedWidth(40)
+        self.btn_quant_data.setFixedHeight(HEIGHT)
+        self.btn_quant_data.clicked.connect(self.choose_quant_data)
+
+        grid.addWidget(self.check_quantize, 14, 0)
+        grid.addWidget(self.line_quant_data, 14, 1, 1, 2)
+        grid.addWidget(self.btn_quant_data, 14, 3)
+
+        # 流水线检测
+        self.check_pipeline = QCheckBox('Pipeline')
+        self.check_pipeline.setToolTip('Run preprocess, inference and postprocess in separate pipelined threads, '
+                                       'not combinable with Budget, Track and Adaptive size')
+
+        grid.addWidget(self.check_pipeline, 15, 0)
+
+        # 切分图块检测高分辨率图像
+        self.check_tile = QCheckBox('Tiles')
+        self.check_tile.setToolTip('Tiled inference: overlapping img_size tiles plus a global view in one batch')
+
+        grid.addWidget(self.check_tile, 15, 1)
+
+        # 按目标尺寸逐帧选择推理分辨率
+        self.check_adaptive = QCheckBox('Adaptive size')
+        self.check_adaptive.setToolTip('Pick the inference size per frame from recently detected object sizes')
+
+        grid.addWidget(self.check_adaptive, 15, 2)
+
+        # 按首帧宽高比固定矩形输入尺寸
+        self.check_rect = QCheckBox('Rect')
+        self.check_rect.setToolTip('Fixed rectangular input shape matching the aspect ratio of the first frame')
+
+        grid.addWidget(self.check_rect, 15, 3)
+
+        # 延迟预算，超出预算时降级检测或跳帧
+        label_budget = QLabel('Budget')
+        self.spin_budget = QDoubleSpinBox()
+        self.spin_budget.setToolTip('Latency (ms) or FPS budget for adaptive frame skipping, 0 to disable')
+        self.spin_budget.setFixedHeight(HEIGHT)
+        self.spin_budget.setDecimals(0)
+        self.spin_budget.setRange(0, 10000)
+        self.combo_budget = QComboBox()
+        self.combo_budget.setFixedHeight(HEIGHT)
+        self.combo_budget.addItems(['ms', 'fps'])
+
+        grid.addWidget(label_budget, 16, 0)
+        grid.addWidget(self.spin_budget, 16, 1, 1, 2)
+        grid.addWidget(self.combo_budget, 16, 3)
+
+        # 运动门控，画面没有变化时复用上一次的检测结果
+        label_motion = QLabel('Motion')
+        self.spin_motion = QDoubleSpinBox()
+        self.spin_motion.setToolTip('Motion gate sensitivity (1-99), reuse detections on static frames, 0 to disable')
+        self.spin_motion.setFixedHeight(HEIGHT)
+        self.spin_motion.setDecimals(0)
+        self.spin_motion.setRange(0, 99)
+
+        grid.addWidget(label_motion, 17, 0)
+        grid.addWidget(self.spin_motion, 17, 1, 1, 3)
+
+        # 多目标跟踪，每隔N帧运行一次检测器
+        label_track = QLabel('Track')
+        self.spin_track = QDoubleSpinBox()
+        self.spin_track.setToolTip('Track objects and run the detector every N frames, 0 to disable')
+        self.spin_track.setFixedHeight(HEIGHT)
+        self.spin_track.setDecimals(0)
+        self.spin_track.setRange(0, 30)
+
+        grid.addWidget(label_track, 18, 0)
+        grid.addWidget(self.spin_track, 18, 1, 1, 3)
+
+        # TTA的缩放比例和翻转，及其计算量估算
+        label_tta = QLabel('TTA')
+        self.line_tta = QLineEdit()
+        self.line_tta.setToolTip('Augmented inference scales with optional lr/ud flips, e.g. "1, 0.83 lr, 0.67"')
+        self.line_tta.setFixedHeight(HEIGHT)
+        self.line_tta.textChanged.connect(self.update_tta_cost)
+        self.check_tta_pad = QCheckBox('Single batch')
+        self.check_tta_pad.setToolTip('Pad all augmented variants to a common shape and run them in one batch')
+        self.check_tta_pad.toggled.connect(self.update_tta_cost)
+        self.combo_size.currentTextChanged.connect(self.update_tta_cost)
+        self.label_tta_cost = QLabel()
+
+        grid.addWidget(label_tta, 19, 0)
+        grid.addWidget(self.line_tta, 19, 1, 1, 2)
+        grid.addWidget(self.check_tta_pad, 19, 3)
+        grid.addWidget(self.label_tta_cost, 20, 1, 1, 3)
+
+        # 模型集成的运行方式和合并方式
+        label_ensemble = QLabel('Ensemble')
+        self.combo_ensemble = QComboBox()
+        self.combo_ensemble.setToolTip('Run ensemble members sequentially, in threads or in processes (CPU only)')
+        self.combo_ensemble.setFixedHeight(HEIGHT)
+        self.combo_ensemble.addItems(['sequential', 'thread', 'process'])
+        self.combo_merge = QComboBox()
+        self.combo_merge.setToolTip('Merge ensemble outputs by NMS or weighted boxes fusion')
+        self.combo_merge.setFixedHeight(HEIGHT)
+        self.combo_merge.addItems(['nms', 'wbf'])
+
+        grid.addWidget(label_ensemble, 21, 0)
+        grid.addWidget(self.combo_ensemble, 21, 1, 1, 2)
+        grid.addWidget(self.combo_merge, 21, 3)
+
+        # NMS引擎
+        label_nms = QLabel('NMS')
+        self.combo_nms = QComboBox()
+        self.combo_nms.setToolTip('NMS engine: greedy (torchvision), or the IoU-matrix Matrix/Cluster/Soft-NMS')
+        self.combo_nms.setFixedHeight(HEIGHT)
+        self.combo_nms.addItems(['greedy', 'matrix', 'cluster', 'soft'])
+
+        # 先按置信度阈值筛选再解码检测框
+        self.check_sparse = QCheckBox('Sparse decode')
+        self.check_sparse.setToolTip('Threshold objectness in the Detect head and only decode the surviving anchors')
+
+        grid.addWidget(label_nms, 22, 0)
+        grid.addWidget(self.combo_nms, 22, 1, 1, 2)
+        grid.addWidget(self.check_sparse, 22, 3)
+
+        # 只检测部分类别，裁剪检测头
+        label_classes = QLabel('Classes')
+        self.line_classes = QLineEdit()
+        self.line_classes.setToolTip('Prune the detection head to these classes (indices or names, comma separated), '
+                                     'empty for all classes')
+        self.line_classes.setPlaceholderText('all classes, e.g. person, car, 7')
+        self.line_classes.setFixedHeight(HEIGHT)
+
+        grid.addWidget(label_classes, 23, 0)
+        grid.addWidget(self.line_classes, 23, 1, 1, 3)
 
         box = QGroupBox()
         box.setLayout(grid)
@@ -151,13 +366,20 @@ class SettingsDialog(QDialog):
     def choose_weights_file(self):
         """从系统中选择权重文件"""
         weights_path = '.'
-        weights = gb.get_config('weights', '')
+        weights = gb.get_config('weights', '').split(';')[0]
         if os.path.exists(weights):
             weights_path = os.path.dirname(weights)
-        file = QFileDialog.getOpenFileName(self, "Pre-trained YOLOv5 Weights", weights_path,
-                                           "Weights Files (*.pt);;All Files (*)")
-        if file[0] != '':
-            self.line_weights.setText(file[0])
+        # 选择多个文件时组成模型集成
+        files = QFileDialog.getOpenFileNames(self, "Pre-trained YOLOv5 Weights", weights_path,
+                                             "Weights Files (*.pt *.mmap *.onnx *.xml);;All Files (*)")
+        if files[0]:
+            self.line_weights.setText(';'.join(files[0]))
+
+    def choose_quant_data(self):
+        """从系统中选择INT8量化校准图片文件夹"""
+        folder = QFileDialog.getExistingDirectory(self, "Calibration Images", self.line_quant_data.text() or '.')
+        if folder != '':
+            self.line_quant_data.setText(folder)
 
     def load_settings(self):
         self.line_weights.setText(gb.get_config('weights', ''))
@@ -170,9 +392,43 @@ class SettingsDialog(QDialog):
         self.check_augment.setChecked(gb.get_config('augment', True))
         self.check_half.setChecked(gb.get_config('half', True))
         self.check_dnn.setChecked(gb.get_config('dnn', False))
+        self.check_buffer.setChecked(gb.get_config('reuse_buffer', False))
+        self.check_raw.setChecked(gb.get_config('raw_input', False))
+        self.check_compile.setChecked(gb.get_config('compile', False))
+        self.spin_ort_intra.setValue(gb.get_config('ort_intra_threads', 0))
+        self.spin_ort_inter.setValue(gb.get_config('ort_inter_threads', 0))
+        self.combo_ort_mode.setCurrentText('parallel' if gb.get_config('ort_parallel', False) else 'sequential')
+        self.combo_ort_level.setCurrentText(gb.get_config('ort_opt_level', 'all'))
+        self.check_ort_iobinding.setChecked(gb.get_config('ort_iobinding', False))
+        self.check_ort_save.setChecked(gb.get_config('ort_save_optimized', True))
+        self.spin_ov_requests.setValue(gb.get_config('ov_requests', 2))
+        self.check_quantize.setChecked(gb.get_config('quantize', False))
+        self.line_quant_data.setText(gb.get_config('quant_data', ''))
+        self.check_pipeline.setChecked(gb.get_config('pipeline', False))
+        self.check_tile.setChecked(gb.get_config('tile', False))
+        self.check_adaptive.setChecked(gb.get_config('adaptive', False))
+        self.check_rect.setChecked(gb.get_config('rect', False))
+        self.spin_budget.setValue(gb.get_config('budget', 0))
+        self.combo_budget.setCurrentText(gb.get_config('budget_unit', 'ms'))
+        self.spin_motion.setValue(gb.get_config('motion', 0))
+        self.spin_track.setValue(gb.get_config('track', 0))
+        self.line_tta.setText(gb.get_config('tta', '1, 0.83 lr, 0.67'))
+        self.check_tta_pad.setChecked(gb.get_config('tta_pad', False))
+        self.combo_ensemble.setCurrentText(gb.get_config('ensemble_mode', 'sequential'))
+        self.combo_merge.setCurrentText(gb.get_config('ensemble_merge', 'nms'))
+        self.combo_nms.setCurrentText(gb.get_config('nms', 'greedy'))
+        self.check_sparse.setChecked(gb.get_config('sparse_decode', False))
+        self.line_classes.setText(gb.get_config('classes', ''))
 
     def save_settings(self):
         """更新配置"""
+        if self.check_pipeline.isChecked() and (self.spin_budget.value() or self.spin_track.value()
+                                                or self.check_adaptive.isChecked()):
+            msg = msg_box.MsgWarning()
+            msg.setText('流水线检测不支持Budget、Track和Adaptive size！\n'
+                        '请关闭Pipeline或这些选项！')
+            msg.exec()
+            return
         config = {
             'weights': self.line_weights.text(),
             'device': self.line_device.text(),
@@ -183,11 +439,55 @@ class SettingsDialog(QDialog):
             'agnostic': self.check_agnostic.isChecked(),
             'augment': self.check_augment.isChecked(),
             'half': self.check_half.isChecked(),
-            'dnn': self.check_dnn.isChecked()
+            'dnn': self.check_dnn.isChecked(),
+            'reuse_buffer': self.check_buffer.isChecked(),
+            'raw_input': self.check_raw.isChecked(),
+            'compile': self.check_compile.isChecked(),
+            'ort_intra_threads': int(self.spin_ort_intra.value()),
+            'ort_inter_threads': int(self.spin_ort_inter.value()),
+            'ort_parallel': self.combo_ort_mode.currentText() == 'parallel',
+            'ort_opt_level': self.combo_ort_level.currentText(),
+            'ort_iobinding': self.check_ort_iobinding.isChecked(),
+            'ort_save_optimized': self.check_ort_save.isChecked(),
+            'ov_requests': int(self.spin_ov_requests.value()),
+            'quantize': self.check_quantize.isChecked(),
+            'quant_data': self.line_quant_data.text(),
+            'pipeline': self.check_pipeline.isChecked(),
+            'tile': self.check_tile.isChecked(),
+            'adaptive': self.check_adaptive.isChecked(),
+            'rect': self.check_rect.isChecked(),
+            'budget': int(self.spin_budget.value()),
+            'budget_unit': self.combo_budget.currentText(),
+            'motion': int(self.spin_motion.value()),
+            'track': int(self.spin_track.value()),
+            'tta': self.line_tta.text(),
+            'tta_pad': self.check_tta_pad.isChecked(),
+            'ensemble_mode': self.combo_ensemble.currentText(),
+            'ensemble_merge': self.combo_merge.currentText(),
+            'nms': self.combo_nms.currentText(),
+            'sparse_decode': self.check_sparse.isChecked(),
+            'classes': self.line_classes.text()
         }
         gb.record_config(config)
         self.accept()
 
+    def update_tta_cost(self):
+        """开启Augment前显示TTA相对于单次推理的计算量估算"""
+        try:
+            scales, _ = parse_tta(self.line_tta.text())
+            cost, passes = tta_cost(scales, int(self.combo_size.currentText()), self.check_tta_pad.isChecked())
+        except ValueError:
+            self.label_tta_cost.setText('Invalid TTA, e.g. "1, 0.83 lr, 0.67"')
+            return
+        self.label_tta_cost.setText(f'Estimated cost: {cost:.2f}x compute in {passes} forward pass(es)')
+
+    def budget(self):
+        """延迟预算(s)，按FPS设置时换算为每帧的时间，0表示不限制"""
+        value = self.spin_budget.value()
+        if not value:
+            return 0
+        return value / 1000 if self.combo_budget.currentText() == 'ms' else 1 / value
+
     def restore(self):
         """恢复原配置"""
         self.load_settings()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+Desc:
+    SORT风格的多目标跟踪：匀速运动模型的卡尔曼滤波预测目标框，检测帧上按IoU关联检测结果与轨迹
+    检测器每隔若干帧运行一次，中间帧用预测的目标框代替检测结果，轨迹置信度衰减过快时提前检测
+"""
+
+import numpy as np
+
+from yolo import DetectResult
+
+
+def box_iou(a, b):
+    """两组(x, y, w, h)目标框两两之间的IoU，返回(len(a), len(b))的矩阵"""
+    a1, a2 = a[:, None, :2], a[:, None, :2] + a[:, None, 2:]
+    b1, b2 = b[None, :, :2], b[None, :, :2] + b[None, :, 2:]
+    inter = (np.minimum(a2, b2) - np.maximum(a1, b1)).clip(0).prod(2)
+    return inter / (a[:, None, 2:].prod(2) + b[None, :, 2:].prod(2) - inter + 1e-9)
+
+
+def linear_assignment(cost):
+    """最小代价匹配，返回匹配的(行, 列)，没有安装scipy时使用贪心匹配"""
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        rows, cols = [], []
+        for i in np.argsort(cost, axis=None):  # 代价从小到大依次匹配
+            r, c = divmod(int(i), cost.shape[1])
+            if r not in rows and c not in cols:
+                rows.append(r)
+                cols.append(c)
+        return np.array(rows, dtype=int), np.array(cols, dtype=int)
+    return linear_sum_assignment(cost)
+
+
+class KalmanTrack:
+    """单个目标的轨迹，状态为(cx, cy, w, h)及其速度(每秒)，噪声与目标高度成比例"""
+    std_pos = 1 / 20  # 位置噪声(相对于目标高度)
+    std_vel = 30 / 160  # 速度噪声(相对于目标高度，每帧1/160，按30fps换算为每秒)
+
+    def __init__(self, tid, xywh, conf, cls, timestamp):
+        self.id = tid
+        cx, cy = xywh[:2] + xywh[2:] / 2
+        self.x = np.array([cx, cy, xywh[2], xywh[3], 0, 0, 0, 0], dtype=np.float64)  # 状态
+        h = xywh[3]
+        std = np.array([2 * self.std_pos * h] * 4 + [10 * self.std_vel * h] * 4)
+        self.P = np.diag(std ** 2)  # 状态协方差
+        self.conf = float(conf)  # 最近一次匹配到的检测置信度
+        self.cls = int(cls)
+        self.timestamp = timestamp  # 状态对应的时刻
+        self.updated = timestamp  # 最近一次匹配到检测的时刻
+        self.misses = 0  # 连续没有匹配到检测的检测帧数
+
+    def predict(self, timestamp):
+        """预测到timestamp时刻的状态"""
+        dt = max(timestamp - self.timestamp, 0)
+        if dt == 0:
+            return
+        F = np.eye(8)
+        F[:4, 4:] = np.eye(4) * dt
+        h = self.x[3]
+        q = np.array([self.std_pos * h] * 4 + [self.std_vel * h] * 4) ** 2 * (dt * 30)  # 噪声方差按30fps的帧数缩放
+        self.x = F @ self.x
+        self.x[2:4] = self.x[2:4].clip(1e-4)  # 宽高保持为正
+        self.P = F @ self.P @ F.T + np.diag(q)
+        self.timestamp = timestamp
+
+    def update(self, xywh, conf, cls):
+        """用匹配到的检测框校正状态"""
+        z = np.concatenate([xywh[:2] + xywh[2:] / 2, xywh[2:]])
+        H = np.eye(4, 8)
+        R = np.diag((np.array([self.std_pos * self.x[3]] * 4)) ** 2)
+        S = H @ self.P @ H.T + R
+        K = self.P @ H.T @ np.linalg.inv(S)
+        self.x = self.x + K @ (z - H @ self.x)
+        self.P = (np.eye(8) - K @ H) @ self.P
+        self.conf, self.cls = float(conf), int(cls)
+        self.updated = self.timestamp
+        self.misses = 0
+
+    @property
+    def xywh(self):
+        cx, cy, w, h = self.x[:4]
+        return np.array([cx - w / 2, cy - h / 2, w, h])
+
+    def confidence(self, half_life):
+        """轨迹置信度，距上一次匹配到检测的时间越长衰减越多"""
+        return self.conf * 0.5 ** ((self.timestamp - self.updated) / half_life)
+
+
+class Tracker:
+    """多目标跟踪器
+
+    detect_every: 每隔多少帧运行一次检测器，1表示每帧检测(只用于分配ID)
+    conf_thres: 轨迹置信度低于该值时提前运行检测器
+    """
+
+    def __init__(self, detect_every=5, conf_thres=0.25, iou_thres=0.3, max_misses=2, half_life=0.5):
+        self.detect_every = detect_every
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres  # 匹配的最小IoU
+        self.max_misses = max_misses  # 连续多少个检测帧没有匹配到检测时删除轨迹
+        self.half_life = half_life  # 置信度衰减一半所需的时间(s)
+        self.tracks = []
+        self.next_id = 1
+        self.since_detect = detect_every  # 距上一次检测的帧数，第一帧即检测
+        self.names, self.colors = (), ()
+
+    def need_detect(self, timestamp):
+        """本帧是否需要运行检测器"""
+        if self.since_detect + 1 >= self.detect_every:
+            return True
+        tracks = [t for t in self.tracks if t.misses == 0]  # 正在显示的轨迹
+        for t in tracks:
+            t.predict(timestamp)
+        return any(t.confidence(self.half_life) < self.conf_thres for t in tracks)
+
+    def predict(self, timestamp):
+        """不检测的帧：返回各轨迹预测的目标框"""
+        self.since_detect += 1
+        for t in self.tracks:
+            t.predict(timestamp)
+        return self.result()
+
+    def update(self, objects, timestamp):
+        """检测帧：关联检测结果与轨迹，返回带有轨迹ID的检测结果"""
+        self.since_detect = 0
+        self.names, self.colors = objects.names, objects.colors
+        for t in self.tracks:
+            t.predict(timestamp)
+        n = len(objects)
+        matched_t, matched_d = [], []
+        if self.tracks and n:
+            iou = box_iou(np.stack([t.xywh for t in self.tracks]), objects.xywh.astype(np.float64))
+            iou *= np.array([t.cls for t in self.tracks])[:, None] == objects.cls[None]  # 只匹配同类
+            rows, cols = linear_assignment(-iou)
+            keep = iou[rows, cols] >= self.iou_thres
+            matched_t, matched_d = rows[keep].tolist(), cols[keep].tolist()
+        for i, j in zip(matched_t, matched_d):
+            self.tracks[i].update(objects.xywh[j].astype(np.float64), objects.conf[j], objects.cls[j])
+        for i, t in enumerate(self.tracks):
+            if i not in matched_t:
+                t.misses += 1
+        ids = np.zeros(n, dtype=np.int64)
+        for j, i in zip(matched_d, matched_t):
+            ids[j] = self.tracks[i].id
+        for j in set(range(n)) - set(matched_d):  # 新目标
+            self.tracks.append(KalmanTrack(self.next_id, objects.xywh[j].astype(np.float64), objects.conf[j],
+                                           objects.cls[j], timestamp))
+            ids[j] = self.next_id
+            self.next_id += 1
+        self.tracks = [t for t in self.tracks if t.misses < self.max_misses]
+        return DetectResult(objects.xywh, objects.conf, objects.cls, objects.names, objects.colors, ids=ids)
+
+    def result(self):
+        """各轨迹当前的目标框，置信度为衰减后的轨迹置信度"""
+        tracks = [t for t in self.tracks if t.misses == 0]  # 最近一次检测中未匹配到的轨迹不显示
+        if not tracks:
+            return DetectResult(names=self.names, colors=self.colors, ids=np.zeros(0, dtype=np.int64))
+        return DetectResult(np.stack([t.xywh for t in tracks]).astype(np.float32),
+                            np.array([t.confidence(self.half_life) for t in tracks], dtype=np.float32),
+                            np.array([t.cls for t in tracks], dtype=np.int64), self.names, self.colors,
+                            ids=np.array([t.id for t in tracks], dtype=np.int64))
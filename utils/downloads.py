@@ -11,7 +11,6 @@ import urllib
 from pathlib import Path
 from zipfile import ZipFile
 
-import requests
 import torch
 
 
@@ -57,6 +56,7 @@ def attempt_download(file, repo='ultralytics/yolov5'):  # from utils.downloads i
             return file
 
         # GitHub assets
+        import requests  # lazy import, only needed to download missing weights
         file.parent.mkdir(parents=True, exist_ok=True)  # make parent dir (if required)
         try:
             response = requests.get(f'https://api.github.com/repos/{repo}/releases/latest').json()  # github api
@@ -15,6 +15,7 @@ import shutil
 import signal
 import time
 import urllib
+from collections import OrderedDict
 from itertools import repeat
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
@@ -23,11 +24,8 @@ from zipfile import ZipFile
 
 import cv2
 import numpy as np
-import pandas as pd
 import pkg_resources as pkg
 import torch
-import torchvision
-import yaml
 
 from utils.downloads import gsutil_getsize
 from utils.metrics import box_iou, fitness
@@ -42,7 +40,6 @@ FONT = 'Arial.ttf'  # https://ultralytics.com/assets/Arial.ttf
 
 torch.set_printoptions(linewidth=320, precision=5, profile='long')
 np.set_printoptions(linewidth=320, formatter={'float_kind': '{:11.5g}'.format})  # format short g, %precision=5
-pd.options.display.max_columns = 10
 cv2.setNumThreads(0)  # prevent OpenCV from multithreading (incompatible with PyTorch DataLoader)
 os.environ['NUMEXPR_MAX_THREADS'] = str(NUM_THREADS)  # NumExpr max threads
 
@@ -143,6 +140,31 @@ class WorkingDirectory(contextlib.ContextDecorator):
         os.chdir(self.cwd)
 
 
+class GridCache:
+    # Bounded LRU cache of detection grids keyed by i.e. (level, ny, nx, device, dtype), with hit/miss counters
+    def __init__(self, size=32):
+        self.size = size  # maximum number of cached entries
+        self.cache = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key, make):  # cached value of key, make() builds it on a miss
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)  # most recently used
+            return self.cache[key]
+        self.misses += 1
+        self.cache[key] = value = make()
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)  # evict least recently used
+        return value
+
+    def clear(self):
+        self.cache.clear()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(entries={len(self.cache)}/{self.size}, hits={self.hits}, misses={self.misses})'
+
+
 def try_except(func):
     # try-except function. Usage: @try_except decorator
     def handler(*args, **kwargs):
@@ -405,6 +427,7 @@ def check_dataset(data, autodownload=True):
 
     # Read yaml (optional)
     if isinstance(data, (str, Path)):
+        import yaml  # lazy import, only needed for datasets
         with open(data, errors='ignore') as f:
             data = yaml.safe_load(f)  # dictionary
 
@@ -673,98 +696,196 @@ def clip_coords(boxes, shape):
         boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, shape[0])  # y1, y2
 
 
+NMS_ENGINES = ('greedy', 'matrix', 'cluster', 'soft')  # non_max_suppression() engines
+
+
+def matrix_nms(boxes, scores, iou_thres=0.45, conf_thres=0.25, engine='matrix', sigma=0.5):
+    """NMS computed with parallel IoU-matrix operations instead of the sequential greedy loop
+
+    Arguments:
+        boxes: (n,4) xyxy, offset by class for class-aware NMS
+        engine: 'matrix' Matrix-NMS https://arxiv.org/abs/2003.10152, gaussian decay by the most overlapping
+                    higher scoring box, compensated by how much that box is suppressed itself
+                'cluster' Cluster-NMS https://arxiv.org/abs/2005.03572, iterated matrix suppression with the same
+                    result as greedy NMS
+                'soft' Cluster-NMS with gaussian score penalty, a parallel Soft-NMS: boxes are decayed by every
+                    overlapping box kept by Cluster-NMS
+
+    Returns:
+        indices of the kept boxes sorted by decayed score, decayed scores of all boxes
+    """
+    order = scores.argsort(descending=True)
+    iou = box_iou(boxes[order], boxes[order]).triu_(diagonal=1)  # iou(i,j) with higher scoring box i < j
+    decay = torch.ones_like(scores)
+    if engine == 'matrix':
+        comp = iou.max(0)[0]  # compensation, max iou of each box with a higher scoring box
+        decay[order] = torch.exp((comp[:, None] ** 2 - iou ** 2) / sigma).min(0)[0]
+    else:
+        keep = iou.max(0)[0] < iou_thres
+        for _ in range(200):  # converges in a few iterations, bounded by the longest suppression chain
+            keep_ = (iou * keep[:, None]).max(0)[0] < iou_thres  # only kept boxes suppress
+            if keep_.equal(keep):
+                break
+            keep = keep_
+        if engine == 'cluster':
+            decay[order] = keep.to(decay.dtype)
+        else:
+            decay[order] = torch.exp(-(iou * keep[:, None]) ** 2 / sigma).prod(0)
+    scores = scores * decay
+    i = order[scores[order] > (conf_thres if engine != 'cluster' else 0)]
+    return i[scores[i].argsort(descending=True)], scores
+
+
 def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=(), max_det=300):
+                        labels=(), max_det=300, engine='greedy', sigma=0.5):
     """Runs Non-Maximum Suppression (NMS) on inference results
 
+    All images of the batch are suppressed in a single NMS call, boxes are offset by image index and class
+    engine: 'greedy' (torchvision), or the IoU-matrix engines 'matrix', 'cluster' and 'soft' (see matrix_nms())
+    sigma: gaussian score decay of the 'matrix' and 'soft' engines
+
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
     """
+    import torchvision  # lazy import, torchvision is slow to import and only needed here
 
+    bs = prediction.shape[0]  # batch size
     nc = prediction.shape[2] - 5  # number of classes
-    xc = prediction[..., 4] > conf_thres  # candidates
 
     # Checks
     assert 0 <= conf_thres <= 1, f'Invalid Confidence threshold {conf_thres}, valid values are between 0.0 and 1.0'
     assert 0 <= iou_thres <= 1, f'Invalid IoU {iou_thres}, valid values are between 0.0 and 1.0'
+    assert engine in NMS_ENGINES, f'Invalid NMS engine {engine}, valid values are {NMS_ENGINES}'
 
     # Settings
     min_wh, max_wh = 2, 7680  # (pixels) minimum and maximum box width and height
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
+    max_nms = 30000 if engine == 'greedy' else 3000  # maximum number of boxes per image into NMS (IoU matrix n^2)
     time_limit = 10.0  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
     merge = False  # use merge-NMS
 
+    def rank(b, conf):  # rank of each box within its image by descending confidence, boxes sorted by image
+        i = conf.argsort(descending=True)
+        n = torch.arange(len(b), device=b.device)
+        i = i[(b[i] * len(b) + n).argsort()]  # by image, then by confidence
+        counts = torch.bincount(b, minlength=bs)
+        r = n - (counts.cumsum(0) - counts)[b[i]]
+        return i, r
+
     t = time.time()
-    output = [torch.zeros((0, 6), device=prediction.device)] * prediction.shape[0]
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
-        x = x[xc[xi]]  # confidence
-
-        # Cat apriori labels if autolabelling
-        if labels and len(labels[xi]):
-            lb = labels[xi]
-            v = torch.zeros((len(lb), nc + 5), device=x.device)
-            v[:, :4] = lb[:, 1:5]  # box
-            v[:, 4] = 1.0  # conf
-            v[range(len(lb)), lb[:, 0].long() + 5] = 1.0  # cls
-            x = torch.cat((x, v), 0)
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Compute conf
-        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
-
-        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-        box = xywh2xyxy(x[:, :4])
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        if multi_label:
-            i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
-            x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
-        else:  # best class only
-            conf, j = x[:, 5:].max(1, keepdim=True)
-            x = torch.cat((box, conf, j.float()), 1)[conf.view(-1) > conf_thres]
-
-        # Filter by class
-        if classes is not None:
-            x = x[(x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)]
-
-        # Apply finite constraint
-        # if not torch.isfinite(x).all():
-        #     x = x[torch.isfinite(x).all(1)]
-
-        # Check shape
-        n = x.shape[0]  # number of boxes
-        if not n:  # no boxes
-            continue
-        elif n > max_nms:  # excess boxes
-            x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
-
-        # Batched NMS
-        c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
-        boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
-        if i.shape[0] > max_det:  # limit detections
-            i = i[:max_det]
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-            iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
-            weights = iou * scores[None]  # box weights
-            x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            if redundant:
-                i = i[iou.sum(1) > 1]  # require redundancy
-
-        output[xi] = x[i]
-        if (time.time() - t) > time_limit:
-            LOGGER.warning(f'WARNING: NMS time limit {time_limit}s exceeded')
-            break  # time limit exceeded
-
-    return output
+    b, j = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # candidates, image and anchor index
+    x = prediction[b, j]
+    x[((x[:, 2:4] < min_wh) | (x[:, 2:4] > max_wh)).any(1), 4] = 0  # width-height
+
+    # Cat apriori labels if autolabelling
+    if labels and any(len(lb) for lb in labels):
+        lb = torch.cat([lb for lb in labels if len(lb)], 0)
+        v = torch.zeros((len(lb), nc + 5), device=x.device)
+        v[:, :4] = lb[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(lb)), lb[:, 0].long() + 5] = 1.0  # cls
+        x = torch.cat((x, v), 0)
+        b = torch.cat((b, torch.cat([torch.full((len(lb),), k, device=b.device) for k, lb in enumerate(labels)
+                                     if len(lb)])), 0)
+
+    # Compute conf
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, b = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), b[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, b = torch.cat((box, conf, j.float()), 1)[i], b[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, b = x[i], b[i]
+
+    # Apply finite constraint
+    # if not torch.isfinite(x).all():
+    #     x = x[torch.isfinite(x).all(1)]
+
+    # Check shape
+    if not x.shape[0]:  # no boxes
+        return [torch.zeros((0, 6), device=prediction.device)] * bs
+    elif x.shape[0] > max_nms:  # excess boxes
+        i, r = rank(b, x[:, 4])
+        i = i[r < max_nms]  # sort by confidence within each image
+        x, b = x[i], b[i]
+
+    # Batched NMS, boxes offset by image and class (offset larger than the box extent keeps groups disjoint)
+    g = b * (1 if agnostic else nc) + (0 if agnostic else x[:, 5].long())  # group index
+    c = g[:, None] * (x[:, :4].max() - x[:, :4].min() + 1)  # offsets
+    boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by image and class), scores
+    if engine != 'greedy':  # IoU-matrix engines, one matrix for the batch unless it gets too large
+        groups = [torch.arange(len(b), device=b.device)] if x.shape[0] <= max_nms else \
+            [(b == bi).nonzero(as_tuple=True)[0] for bi in range(bs)]
+        i = []
+        for k in groups:
+            j, x[k, 4] = matrix_nms(boxes[k], scores[k], iou_thres, conf_thres, engine, sigma)  # decayed scores
+            i.append(k[j])
+        i = torch.cat(i)
+    elif x.shape[0] <= (4000 if x.device.type == 'cpu' else 20000):  # one NMS call for the whole batch
+        i = torchvision.ops.nms(boxes, scores, iou_thres)
+    else:  # NMS cost grows with boxes x kept boxes, run crowded batches image by image
+        i = torch.cat([k[torchvision.ops.nms(boxes[k], scores[k], iou_thres)]
+                       for k in ((b == bi).nonzero(as_tuple=True)[0] for bi in range(bs))])
+    if merge and (1 < x.shape[0] < 3E3):  # Merge NMS (boxes merged using weighted mean)
+        # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
+        iou = box_iou(boxes[i], boxes) > iou_thres  # iou matrix
+        weights = iou * scores[None]  # box weights
+        x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
+        if redundant:
+            i = i[iou.sum(1) > 1]  # require redundancy
+
+    # Limit detections per image
+    k, r = rank(b[i], scores[i])
+    i = i[k[r < max_det]]
+    if (time.time() - t) > time_limit:
+        LOGGER.warning(f'WARNING: NMS time limit {time_limit}s exceeded')
+    return list(x[i].split(torch.bincount(b[i], minlength=bs).tolist()))
+
+
+def weighted_boxes_fusion(detections, iou_thres=0.55, n_models=None, max_det=300):
+    """Fuses the detections of several models with Weighted Boxes Fusion https://arxiv.org/abs/1910.13302
+
+    Vectorized variant: clusters are seeded by class-aware NMS and every box joins the highest scoring seed it
+    overlaps, instead of being matched one by one against the running fused boxes
+
+    Arguments:
+        detections: list of per-model detections for one image, (n,6) tensors [xyxy, conf, cls]
+        n_models: number of models, fused boxes found by fewer models are down-weighted
+
+    Returns:
+         (n,6) tensor of fused detections [xyxy, conf, cls]
+    """
+    import torchvision  # lazy import, torchvision is slow to import
+
+    x = torch.cat(detections, 0)
+    if not x.shape[0]:
+        return x
+    n_models = n_models or len(detections)
+    boxes, scores, cls = x[:, :4], x[:, 4], x[:, 5]
+    seeds = torchvision.ops.batched_nms(boxes, scores, cls, iou_thres)  # cluster seeds, sorted by score
+    match = (box_iou(boxes[seeds], boxes) > iou_thres) & (cls[seeds, None] == cls[None])  # seeds(m) x boxes(n)
+    j = match.byte().argmax(0)  # cluster index of each box, first (highest scoring) matching seed
+
+    # Fused boxes are the score-weighted mean of their cluster, scores are rescaled by the number of models
+    m = len(seeds)
+    weights = x.new_zeros(m).index_add_(0, j, scores)
+    count = x.new_zeros(m).index_add_(0, j, torch.ones_like(scores))
+    fused = x.new_zeros((m, 4)).index_add_(0, j, boxes * scores[:, None]) / weights[:, None]
+    conf = weights / count * count.clamp(max=n_models) / n_models
+    i = conf.argsort(descending=True)[:max_det]
+    return torch.cat((fused, conf[:, None], cls[seeds, None]), 1)[i]
 
 
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
@@ -784,6 +905,10 @@ def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_op
 
 
 def print_mutation(results, hyp, save_dir, bucket, prefix=colorstr('evolve: ')):
+    import pandas as pd  # lazy imports, only needed for training
+    import yaml
+    pd.options.display.max_columns = 10
+
     evolve_csv = save_dir / 'evolve.csv'
     evolve_yaml = save_dir / 'hyp_evolve.yaml'
     keys = ('metrics/precision', 'metrics/recall', 'metrics/mAP_0.5', 'metrics/mAP_0.5:0.95',
@@ -7,7 +7,6 @@ import math
 import warnings
 from pathlib import Path
 
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 
@@ -172,6 +171,7 @@ class ConfusionMatrix:
         return tp[:-1], fp[:-1]  # remove background class
 
     def plot(self, normalize=True, save_dir='', names=()):
+        import matplotlib.pyplot as plt  # lazy import
         try:
             import seaborn as sn
 
@@ -302,6 +302,7 @@ def wh_iou(wh1, wh2):
 
 def plot_pr_curve(px, py, ap, save_dir='pr_curve.png', names=()):
     # Precision-recall curve
+    import matplotlib.pyplot as plt  # lazy import
     fig, ax = plt.subplots(1, 1, figsize=(9, 6), tight_layout=True)
     py = np.stack(py, axis=1)
 
@@ -323,6 +324,7 @@ def plot_pr_curve(px, py, ap, save_dir='pr_curve.png', names=()):
 
 def plot_mc_curve(px, py, save_dir='mc_curve.png', names=(), xlabel='Confidence', ylabel='Metric'):
     # Metric-confidence curve
+    import matplotlib.pyplot as plt  # lazy import
     fig, ax = plt.subplots(1, 1, figsize=(9, 6), tight_layout=True)
 
     if 0 < len(names) < 21:  # display per-class legend if < 21 classes
@@ -10,10 +10,7 @@ from pathlib import Path
 
 import cv2
 import matplotlib
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-import seaborn as sn
 import torch
 from PIL import Image, ImageDraw, ImageFont
 
@@ -126,6 +123,7 @@ def feature_visualization(x, module_type, stage, n=32, save_dir=Path('runs/detec
     n:              Maximum number of feature maps to plot
     save_dir:       Directory to save results
     """
+    import matplotlib.pyplot as plt  # lazy import
     if 'Detect' not in module_type:
         batch, channels, height, width = x.shape  # batch, channels, height, width
         if height > 1 and width > 1:
@@ -240,6 +238,7 @@ def plot_images(images, targets, paths=None, fname='images.jpg', names=None, max
 
 def plot_lr_scheduler(optimizer, scheduler, epochs=300, save_dir=''):
     # Plot LR simulating training for full epochs
+    import matplotlib.pyplot as plt  # lazy import
     optimizer, scheduler = copy(optimizer), copy(scheduler)  # do not modify originals
     y = []
     for _ in range(epochs):
@@ -257,6 +256,7 @@ def plot_lr_scheduler(optimizer, scheduler, epochs=300, save_dir=''):
 
 def plot_val_txt():  # from utils.plots import *; plot_val()
     # Plot val.txt histograms
+    import matplotlib.pyplot as plt  # lazy import
     x = np.loadtxt('val.txt', dtype=np.float32)
     box = xyxy2xywh(x[:, :4])
     cx, cy = box[:, 0], box[:, 1]
@@ -274,6 +274,7 @@ def plot_val_txt():  # from utils.plots import *; plot_val()
 
 def plot_targets_txt():  # from utils.plots import *; plot_targets_txt()
     # Plot targets.txt histograms
+    import matplotlib.pyplot as plt  # lazy import
     x = np.loadtxt('targets.txt', dtype=np.float32).T
     s = ['x targets', 'y targets', 'width targets', 'height targets']
     fig, ax = plt.subplots(2, 2, figsize=(8, 8), tight_layout=True)
@@ -287,6 +288,7 @@ def plot_targets_txt():  # from utils.plots import *; plot_targets_txt()
 
 def plot_val_study(file='', dir='', x=None):  # from utils.plots import *; plot_val_study()
     # Plot file=study.txt generated by val.py (or plot all study*.txt in dir)
+    import matplotlib.pyplot as plt  # lazy import
     save_dir = Path(file).parent if file else Path(dir)
     plot2 = False  # plot additional results
     if plot2:
@@ -326,6 +328,9 @@ def plot_val_study(file='', dir='', x=None):  # from utils.plots import *; plot_
 @Timeout(30)  # known issue https://github.com/ultralytics/yolov5/issues/5611
 def plot_labels(labels, names=(), save_dir=Path('')):
     # plot dataset labels
+    import matplotlib.pyplot as plt  # lazy imports
+    import pandas as pd
+    import seaborn as sn
     LOGGER.info(f"Plotting labels to {save_dir / 'labels.jpg'}... ")
     c, b = labels[:, 0], labels[:, 1:].transpose()  # classes, boxes
     nc = int(c.max() + 1)  # number of classes
@@ -373,6 +378,8 @@ def plot_labels(labels, names=(), save_dir=Path('')):
 
 def plot_evolve(evolve_csv='path/to/evolve.csv'):  # from utils.plots import *; plot_evolve()
     # Plot evolve.csv hyp evolution results
+    import matplotlib.pyplot as plt  # lazy imports
+    import pandas as pd
     evolve_csv = Path(evolve_csv)
     data = pd.read_csv(evolve_csv)
     keys = [x.strip() for x in data.columns]
@@ -400,6 +407,8 @@ def plot_evolve(evolve_csv='path/to/evolve.csv'):  # from utils.plots import *;
 
 def plot_results(file='path/to/results.csv', dir=''):
     # Plot training results.csv. Usage: from utils.plots import *; plot_results('path/to/results.csv')
+    import matplotlib.pyplot as plt  # lazy imports
+    import pandas as pd
     save_dir = Path(file).parent if file else Path(dir)
     fig, ax = plt.subplots(2, 5, figsize=(12, 6), tight_layout=True)
     ax = ax.ravel()
@@ -426,6 +435,7 @@ def plot_results(file='path/to/results.csv', dir=''):
 
 def profile_idetection(start=0, stop=0, labels=(), save_dir=''):
     # Plot iDetection '*.txt' per-image logs. from utils.plots import *; profile_idetection()
+    import matplotlib.pyplot as plt  # lazy import
     ax = plt.subplots(2, 4, figsize=(12, 6), tight_layout=True)[1].ravel()
     s = ['Images', 'Free Storage (GB)', 'RAM Usage (GB)', 'Battery', 'dt_raw (ms)', 'dt_smooth (ms)', 'real-world FPS']
     files = list(Path(save_dir).glob('frames*.txt'))
@@ -227,6 +227,62 @@ def fuse_conv_and_bn(conv, bn):
     return fusedconv
 
 
+def quantize_int8(model, images, backend=None):
+    # Static INT8 post-training quantization of the fused Conv() layers, observers calibrated on images (list of BCHW)
+    from torch import quantization as tq
+    backend = backend or ('fbgemm' if 'fbgemm' in torch.backends.quantized.supported_engines else 'qnnpack')
+    torch.backends.quantized.engine = backend
+    model = deepcopy(model).float().eval()
+    for m in list(model.modules()):
+        if isinstance(getattr(m, 'conv', None), nn.Conv2d) and not hasattr(m, 'bn'):  # Conv() after Model.fuse()
+            m.conv = nn.Sequential(tq.QuantStub(), m.conv, tq.DeQuantStub())  # int8 conv, float activation
+            m.conv.qconfig = tq.get_default_qconfig(backend)
+    tq.prepare(model, inplace=True)  # insert observers
+    with torch.no_grad():
+        for im in images:
+            model(im)  # calibrate
+    with warnings.catch_warnings():
+        if not images:  # structure only, quantization parameters are loaded from a state_dict afterwards
+            warnings.simplefilter('ignore')
+        tq.convert(model, inplace=True)
+    model.int8 = backend  # quantized engine
+    return model
+
+
+def int8_drift(model, qmodel, images):
+    # Relative L2 error of each quantized Conv() output against the FP32 model, averaged over images
+    fp, q = dict(model.named_modules()), dict(qmodel.named_modules())
+    names = [k for k, m in q.items() if isinstance(m, nn.Sequential) and type(m[0]).__name__ == 'Quantize']
+    outputs, drift = {}, {k: 0.0 for k in names}
+    hooks = [fp[k].register_forward_hook(lambda m, i, o, k=k: outputs.update({(k, 0): o})) for k in names] + \
+            [q[k].register_forward_hook(lambda m, i, o, k=k: outputs.update({(k, 1): o})) for k in names]
+    with torch.no_grad():
+        for im in images:
+            model(im)
+            qmodel(im)
+            for k in names:
+                a, b = outputs[(k, 0)].float(), outputs[(k, 1)].float()
+                drift[k] += ((b - a).norm() / (a.norm() + 1E-9)).item() / len(images)
+    for h in hooks:
+        h.remove()
+    return drift
+
+
+def int8_speedup(model, qmodel, im, n=10):
+    # Inference time (ms) of the FP32 model and the quantized model on input im, best of n runs after a warmup
+    t = []
+    with torch.no_grad():
+        for m in model, qmodel:
+            m(im)  # warmup
+            dt = float('inf')
+            for _ in range(n):
+                t0 = time_sync()
+                m(im)
+                dt = min(dt, time_sync() - t0)
+            t.append(dt * 1000)
+    return t
+
+
 def model_info(model, verbose=False, img_size=640):
     # Model information. img_size may be int or list, i.e. img_size=640 or img_size=[640, 320]
     n_p = sum(x.numel() for x in model.parameters())  # number parameters
@@ -251,7 +307,7 @@ def model_info(model, verbose=False, img_size=640):
     LOGGER.info(f"Model Summary: {len(list(model.modules()))} layers, {n_p} parameters, {n_g} gradients{fs}")
 
 
-def scale_img(img, ratio=1.0, same_shape=False, gs=32):  # img(16,3,256,416)
+def scale_img(img, ratio=1.0, same_shape=False, gs=32, value=0.447):  # img(16,3,256,416)
     # scales img(bs,3,y,x) by ratio constrained to gs-multiple
     if ratio == 1.0:
         return img
@@ -261,7 +317,7 @@ def scale_img(img, ratio=1.0, same_shape=False, gs=32):  # img(16,3,256,416)
         img = F.interpolate(img, size=s, mode='bilinear', align_corners=False)  # resize
         if not same_shape:  # pad/crop img
             h, w = (math.ceil(x * ratio / gs) * gs for x in (h, w))
-        return F.pad(img, [0, w - s[1], 0, h - s[0]], value=0.447)  # value = imagenet mean
+        return F.pad(img, [0, w - s[1], 0, h - s[0]], value=value)  # value = imagenet mean
 
 
 def copy_attr(a, b, include=(), exclude=()):
@@ -15,8 +15,13 @@ from PySide2.QtGui import QPainter, QColor, Qt, QPixmap, QImage, QFont, QBrush,
 from PySide2.QtWidgets import QWidget
 
 import msg_box
+import profiler
+from frame_bus import FrameBus
+from pipeline import DetectPipeline
+from scheduler import FrameScheduler, MotionGate, ResolutionController
+from tracker import Tracker
 from gb import thread_runner, YOLOGGER
-from yolo import YOLO5
+from yolo import YOLO5, DetectResult
 
 
 class WidgetCamera(QWidget):
@@ -24,6 +29,11 @@ class WidgetCamera(QWidget):
         super(WidgetCamera, self).__init__()
 
         self.yolo = YOLO5()
+        self.pipeline = DetectPipeline(self.yolo)  # 流水线检测
+        self.scheduler = None  # 自适应跳帧控制器
+        self.gate = None  # 运动门控
+        self.tracker = None  # 多目标跟踪
+        self.resolution = None  # 自适应推理分辨率
 
         self.opened = False  # 摄像头已打开
         self.detecting = False  # 目标检测中
@@ -33,11 +43,12 @@ class WidgetCamera(QWidget):
         self.writer = cv2.VideoWriter()  # VideoWriter，打开摄像头后再初始化
 
         self.pix_image = None  # QPixmap视频帧
-        self.image = None  # 当前读取到的图片
+        self.bus = FrameBus()  # 读取到的视频帧
         self.scale = 1  # 比例
-        self.objects = []
+        self.objects = DetectResult()  # 检测结果
 
         self.fps = 0  # 帧率
+        self.latency = 0  # 端到端延迟(s)
 
     def open_camera(self, use_camera, video):
         """打开摄像头，成功打开返回True"""
@@ -47,6 +58,7 @@ class WidgetCamera(QWidget):
             cam = video  # 视频流文件
         flag = self.cap.open(cam)  # 打开camera
         if flag:
+            self.bus.reset()
             self.opened = True  # 已打开
             return True
         else:
@@ -60,63 +72,71 @@ class WidgetCamera(QWidget):
         YOLOGGER.info('关闭摄像头')
         self.opened = False  # 先关闭目标检测线程再关闭摄像头
         self.stop_detect()  # 停止目标检测线程
+        self.bus.close()  # 唤醒等待新帧的线程
         time.sleep(0.1)  # 等待读取完最后一帧画面，读取一帧画面0.1s以内，一般0.02~0.03s
         self.cap.release()
         self.reset()  # 恢复初始状态
 
     @thread_runner
     def show_camera(self, fps=0):
-        """传入参数帧率，摄像头使用默认值0，视频一般取30|60"""
+        """传入参数帧率，摄像头使用默认值0(读取本身会阻塞到下一帧)，视频一般取30|60"""
         YOLOGGER.info('显示画面线程开始')
         wait = 1 / fps if fps else 0
+        t = time.time()  # 下一帧的读取时刻
         while self.opened:
-            self.read_image()  # 0.1s以内，一般0.02~0.03s
+            if not self.read_image():  # 0.1s以内，一般0.02~0.03s
+                time.sleep(0.01)  # 读取失败(如视频已结束)时避免空转
             if fps:
-                time.sleep(wait)  # 等待wait秒读取一帧画面并显示
+                t = max(t + wait, time.time())  # 按固定间隔读取，落后时不追赶
+                time.sleep(max(t - time.time(), 0))
             self.update()
         self.update()
         YOLOGGER.info('显示画面线程结束')
 
     def read_image(self):
+        """读取一帧并发布到帧总线，读取成功返回True"""
         ret, img = self.cap.read()
         if ret:
             # 删去最后一层
             if img.shape[2] == 4:
                 img = img[:, :, :-1]
-            self.image = img
+            self.bus.publish(img)
+        return ret
 
     @thread_runner
-    def run_video_recorder(self, fps=30):
-        """运行视频写入器"""
+    def run_video_recorder(self, fps=0):
+        """运行视频写入器，按序号写入读取到的每一帧，fps为0时使用视频流的帧率"""
         YOLOGGER.info('视频录制线程开始')
         now = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
+        fps = fps or self.cap.get(cv2.CAP_PROP_FPS) or 30
         # 确保输出文件夹存在
         path = 'output'
         if not os.path.exists(path):
             os.mkdir(path)
-        # 等待有画面
-        t0 = time.time()
-        while self.image is None:
-            time.sleep(0.01)
-            # 避免由于没有画面导致线程无法退出
-            if time.time() - t0 > 3:
-                YOLOGGER.warning('超时未获取到帧, 视频录制失败!')
-                break
-
-        # 有画面了，可以开始写入
-        if self.image is not None:
+        # 等待有画面，避免由于没有画面导致线程无法退出
+        frame = self.bus.wait_next(timeout=3)
+        if frame is None:
+            YOLOGGER.warning('超时未获取到帧, 视频录制失败!')
+        else:  # 有画面了，可以开始写入
             # 打开视频写入器
-            h, w, _ = self.image.shape
+            h, w, _ = frame.image.shape
             self.writer.open(
                 filename=f'{path}/{now}_record.avi',
                 fourcc=self.fourcc,
                 fps=fps,
                 frameSize=(w, h))  # 保存视频
 
-            wait = 1 / fps - 0.004  # 间隔多少毫秒，减掉大概1~5ms的写入时间
-            while self.opened:
-                self.writer.write(self.image)  # 写入一帧画面，大概耗时1~2ms
-                time.sleep(wait)
+            dropped = 0  # 来不及写入而被挤出缓冲区的帧数
+            while frame is not None:
+                self.writer.write(frame.image)  # 写入一帧画面，大概耗时1~2ms
+                seq = frame.seq
+                frame = self.bus.wait_next(seq, timeout=0.1)
+                while frame is None and self.opened:  # 摄像头关闭后写完缓冲区中剩余的帧再退出
+                    frame = self.bus.wait_next(seq, timeout=0.1)
+                if frame is not None:
+                    dropped += frame.seq - seq - 1
+            if dropped:
+                YOLOGGER.warning(f'视频录制丢失{dropped}帧')
         YOLOGGER.info('视频录制线程结束')
 
     def stop_video_recorder(self):
@@ -132,22 +152,101 @@ class WidgetCamera(QWidget):
             msg.exec()
 
     @thread_runner
-    def start_detect(self):
+    def start_detect(self, pipeline=False, budget=0, motion=0, track=0, adaptive=False):
+        """budget为延迟预算(s)，超出预算时降级检测或跳帧，0表示不限制，仅用于非流水线的同步检测
+
+        motion为运动门控的灵敏度(0~1)，画面没有变化时复用上一次的检测结果，0表示不使用
+        track为跟踪时每隔多少帧运行一次检测器，中间帧使用跟踪预测的目标框，0表示不跟踪，仅用于非流水线的同步检测
+        adaptive为True时按最近检测到的目标尺寸逐帧选择推理分辨率，仅用于非流水线、不切分图块的同步检测
+        """
         # 初始化yolo参数
         YOLOGGER.info('目标检测线程开始')
         self.detecting = True
+        pipeline = pipeline and not self.yolo.is_xml  # OpenVINO使用自身的异步推理
+        if (pipeline or self.yolo.is_xml) and (budget or track or adaptive):  # 旧的配置文件中可能同时开启
+            mode = 'OpenVINO异步检测' if self.yolo.is_xml else '流水线检测'
+            YOLOGGER.warning(f'{mode}不支持延迟预算、目标跟踪和自适应分辨率，已忽略这些设置')
+        if pipeline:
+            self.pipeline.start()
+            self.collect_detect()
+        self.scheduler = None if pipeline or self.yolo.is_xml else FrameScheduler(
+            budget, self.yolo.opt['img_size'], augment=self.yolo.opt['augment'], resizable=self.yolo.resizable,
+            stride=self.yolo.stride)
+        self.gate = MotionGate(motion) if motion else None
+        self.tracker = Tracker(track, conf_thres=self.yolo.opt['conf_thresh'] / 2) \
+            if track and self.scheduler is not None else None
+        self.resolution = ResolutionController(self.yolo.opt['img_size'], stride=self.yolo.stride) \
+            if adaptive and self.scheduler is not None and self.yolo.resizable and not self.yolo.opt['tile'] else None
+        self.yolo.frame_shape = None  # 固定矩形输入时按新视频源的首帧重新确定输入尺寸
+        seq = 0  # 上一次检测的帧序号，每帧只检测一次
         while self.detecting:
-            if self.image is None:
+            frame = self.bus.wait_latest(seq, timeout=0.1)  # 等待新帧，跳过来不及检测的旧帧
+            if frame is None:
+                continue
+            if self.resolution is not None and seq == 0:  # 按第一帧的尺寸预热各分辨率
+                self.yolo.warmup(frame.image.shape, self.resolution.sizes)
+            seq = frame.seq
+            if self.gate is not None and not self.gate.changed(frame.image):  # 画面没有变化，复用上一次的检测结果
                 continue
             # 检测
+            if pipeline:  # 送入流水线，队列已满时阻塞
+                while self.detecting and not self.pipeline.put(frame.image, timeout=0.1, t0=frame.timestamp):
+                    pass
+                continue
+            if self.tracker is not None and not self.tracker.need_detect(frame.timestamp):  # 用跟踪预测的目标框代替检测
+                self.objects = self.tracker.predict(frame.timestamp)
+                self.update()
+                continue
+            if self.scheduler is not None:
+                decision = self.scheduler.decide(frame.timestamp)
+                if decision == FrameScheduler.SKIP:  # 保留上一次的检测结果，跟踪时使用预测的目标框
+                    if self.tracker is not None:
+                        self.objects = self.tracker.predict(frame.timestamp)
+                        self.update()
+                    continue
             t0 = time.time()
-            self.objects = self.yolo.obj_detect(self.image)
+            if self.yolo.is_xml:  # OpenVINO异步推理，当前帧的预处理与上一帧的推理同时进行
+                objects = self.yolo.obj_detect_async(frame.image)
+                if objects is not None:
+                    self.objects = objects
+            else:
+                options = self.scheduler.options(decision)
+                if self.resolution is not None and decision == FrameScheduler.DETECT:
+                    options['img_size'] = self.resolution.select()
+                self.objects = self.yolo.obj_detect(frame.image, **options)
+                self.scheduler.update(decision, time.time() - t0)
+                if self.resolution is not None:
+                    self.resolution.update(self.objects, frame.image.shape)
+                if self.tracker is not None:
+                    self.objects = self.tracker.update(self.objects, frame.timestamp)
             t1 = time.time()
             self.fps = 1 / (t1 - t0)
+            self.latency = t1 - frame.timestamp  # 从采集到检测完成
             self.update()
+            if profiler.ENABLED:
+                profiler.mark('首帧检测完成')
+                profiler.report()
+        if self.yolo.is_xml:
+            self.yolo.flush_async()  # 等待未完成的异步推理
+        self.pipeline.stop()
         self.update()
         YOLOGGER.info('目标检测线程结束')
 
+    @thread_runner
+    def collect_detect(self):
+        """取出流水线的检测结果，帧率为流水线吞吐量"""
+        while self.detecting:
+            result = self.pipeline.get(timeout=0.1)
+            if result is None:
+                continue
+            _, self.objects = result
+            self.fps = self.pipeline.fps
+            self.latency = self.pipeline.latency
+            self.update()
+            if profiler.ENABLED:
+                profiler.mark('首帧检测完成')
+                profiler.report()
+
     def stop_detect(self):
         """停止目标检测"""
         self.detecting = False
@@ -156,10 +255,10 @@ class WidgetCamera(QWidget):
         """恢复初始状态"""
         self.opened = False  # 摄像头关闭
         self.pix_image = None  # 无QPixmap视频帧
-        self.image = None  # 当前无读取到的图片
         self.scale = 1  # 比例无
-        self.objects = []  # 无检测到的目标
+        self.objects = DetectResult()  # 无检测到的目标
         self.fps = 0  # 帧率无
+        self.latency = 0  # 延迟无
 
     def resizeEvent(self, event):
         self.update()
@@ -185,12 +284,14 @@ class WidgetCamera(QWidget):
             qp.drawPixmap(sw / 2 - 100, sh / 2 - 100, 200, 200, QPixmap('img/video.svg'))
 
         # 画图
-        if self.opened and self.image is not None:
-            ih, iw, _ = self.image.shape
+        frame = self.bus.latest()
+        if self.opened and frame is not None:
+            image = frame.image
+            ih, iw, _ = image.shape
             self.scale = sw / iw if sw / iw < sh / ih else sh / ih  # 缩放比例
             px = round((sw - iw * self.scale) / 2)
             py = round((sh - ih * self.scale) / 2)
-            qimage = QImage(self.image.data, iw, ih, 3 * iw, QImage.Format_BGR888)  # 转QImage
+            qimage = QImage(image.data, iw, ih, 3 * iw, QImage.Format_BGR888)  # 转QImage
             qpixmap = QPixmap.fromImage(qimage.scaled(sw, sh, Qt.KeepAspectRatio))  # 转QPixmap
             pw, ph = qpixmap.width(), qpixmap.height()  # 缩放后的QPixmap大小
             qp.drawPixmap(px, py, qpixmap)
@@ -204,16 +305,16 @@ class WidgetCamera(QWidget):
             qp.setBrush(brush1)
             pen = QPen()
             pen.setWidth(2)  # 边框宽度
-            for obj in self.objects:
-                rgb = [round(c) for c in obj['color']]
+            objects = self.objects
+            # 坐标 宽高
+            rects = (objects.xywh * [pw, ph, pw, ph]).round().astype(int) + [px, py, 0, 0]
+            for i, (ox, oy, ow, oh) in enumerate(rects.tolist()):
+                rgb = [round(c) for c in objects.color(i)]
                 pen.setColor(QColor(rgb[0], rgb[1], rgb[2]))  # 边框颜色
                 qp.setPen(pen)
-                # 坐标 宽高
-                ox, oy = px + round(pw * obj['x']), py + round(ph * obj['y'])
-                ow, oh = round(pw * obj['w']), round(ph * obj['h'])
                 obj_rect = QRect(ox, oy, ow, oh)
                 qp.drawRect(obj_rect)  # 画矩形框
 
                 # 画 类别 和 置信度
-                qp.drawText(ox, oy - 5, str(obj['class']) + str(round(obj['confidence'], 2)))
+                qp.drawText(ox, oy - 5, objects.label(i))
 
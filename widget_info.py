@@ -19,6 +19,15 @@ class WidgetInfo(QWidget):
         self.label_fps = QLabel('FPS: ')
         vbox.addWidget(self.label_fps)
 
+        self.label_latency = QLabel('Latency: ')  # 端到端延迟
+        vbox.addWidget(self.label_latency)
+
+        self.label_decision = QLabel('Decision: ')  # 跳帧控制器的当前决策
+        vbox.addWidget(self.label_decision)
+
+        self.label_skipped = QLabel('Skipped: ')  # 运动门控跳过的推理次数
+        vbox.addWidget(self.label_skipped)
+
         box = QGroupBox()
         box.setLayout(vbox)
 
@@ -29,3 +38,12 @@ class WidgetInfo(QWidget):
 
     def update_fps(self, fps):
         self.label_fps.setText(f'FPS: { "" if fps <= 0 else round(fps, 1)}')
+
+    def update_latency(self, latency):
+        self.label_latency.setText(f'Latency: { "" if latency <= 0 else f"{latency * 1000:.0f} ms"}')
+
+    def update_decision(self, text):
+        self.label_decision.setText(f'Decision: {text}')
+
+    def update_skipped(self, skipped, frames):
+        self.label_skipped.setText(f'Skipped: { "" if frames <= 0 else f"{skipped}/{frames}"}')
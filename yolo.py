@@ -1,5 +1,10 @@
+import hashlib
+import json
+import math
 import os
 import re
+import time
+from collections import deque
 
 import cv2
 import numpy as np
@@ -7,20 +12,153 @@ import torch
 import pkg_resources as pkg
 from pathlib import Path
 
-from models.experimental import attempt_load
-from utils.datasets import letterbox
-from utils.general import (check_img_size, non_max_suppression, scale_coords)
-from utils.torch_utils import select_device
+from models.experimental import Ensemble, attempt_load, load_mmap_header
+from models.yolo import Model
+from utils.datasets import IMG_FORMATS, VID_FORMATS, LoadImages, letterbox
+from utils.general import (NMS_ENGINES, check_img_size, non_max_suppression, scale_coords)
+from utils.torch_utils import int8_drift, int8_speedup, quantize_int8, select_device
 
 from gb import YOLOGGER
 
-SUPPORT_TENSORFLOW = False
-try:
-    pkg.require('tensorflow>=2.4.1')
-    import tensorflow as tf
-    SUPPORT_TENSORFLOW = True
-except pkg.DistributionNotFound as error:
-    YOLOGGER.error(error)
+
+def clean_cache(path='cache', keep=8, days=30):
+    """清理TorchScript编译缓存：torch版本不一致、超过days天未使用以及超出keep个的最久未使用的缓存"""
+    if not os.path.exists(path):
+        return
+    version = f'_torch{torch.__version__.split("+")[0]}.torchscript'
+    files = sorted(Path(path).glob('*.torchscript'), key=lambda x: x.stat().st_mtime, reverse=True)  # 最近使用的在前
+    for i, f in enumerate(files):
+        if not f.name.endswith(version) or i >= keep or time.time() - f.stat().st_mtime > days * 86400:
+            f.unlink()
+            YOLOGGER.info(f'删除过期模型缓存: {f}')
+
+
+def parse_tta(text):
+    """解析TTA配置，如"1, 0.83 lr, 0.67"，每项为缩放比例及可选的翻转(lr左右/ud上下)，返回(scales, flips)"""
+    scales, flips = [], []
+    for item in text.split(','):
+        words = item.split()
+        if not words:
+            continue
+        scale = float(words[0])
+        if not 0 < scale <= 2 or len(words) > 2 or (len(words) == 2 and words[1] not in ('lr', 'ud')):
+            raise ValueError(item.strip())
+        scales.append(scale)
+        flips.append({'lr': 3, 'ud': 2}.get(words[1]) if len(words) == 2 else None)
+    if not scales:
+        raise ValueError(text)
+    return tuple(scales), tuple(flips)
+
+
+def tta_cost(scales, img_size, pad=False, stride=32):
+    """估算TTA的计算量(相对于不使用TTA的单次推理)和前向推理次数，按正方形输入、各变体填充到stride整数倍计算"""
+    sizes = [img_size if s == 1 else math.ceil(img_size * s / stride) * stride for s in scales]
+    if pad:  # 填充到相同尺寸后一次推理
+        return len(sizes) * max(sizes) ** 2 / img_size ** 2, 1
+    return sum(x ** 2 for x in sizes) / img_size ** 2, len(set(sizes))
+
+
+def onnx_input_shape(w):
+    """读取ONNX模型输入的形状(b, c, h, w)，动态维度为字符串，未安装onnx时返回None"""
+    try:
+        import onnx
+    except ImportError:
+        return None
+    dims = onnx.load(w, load_external_data=False).graph.input[0].type.tensor_type.shape.dim
+    return [d.dim_value if d.HasField('dim_value') else d.dim_param for d in dims]
+
+
+class InputBuffer:
+    """预分配的输入缓冲区，每种输入尺寸只保留一块填充画布和一个输入张量，避免逐帧分配内存
+
+    注意: 返回的输入张量会在下一次调用时被覆盖
+    """
+
+    def __init__(self, device, half=False, raw=False, color=114):
+        self.device = device
+        self.dtype = torch.float16 if half else torch.float32
+        self.raw = raw  # 模型直接接收0-255的BGR输入，无需翻转通道和归一化
+        self.color = color  # 填充颜色
+        self.buffers = dict()  # 输入尺寸 -> (画布, 输入张量, 各帧缩放区域)
+
+    def load(self, images, new_shape, stride=32, auto=True):
+        """将各帧直接缩放到画布中，在输入张量上原地归一化，返回BCHW的输入张量"""
+        if isinstance(new_shape, int):
+            new_shape = (new_shape, new_shape)
+        key = (tuple(im.shape for im in images), tuple(new_shape), stride, auto)
+        if key not in self.buffers:
+            if len(self.buffers) >= 8:  # 输入尺寸频繁变化时避免缓冲区无限增长
+                self.buffers.clear()
+            self.buffers[key] = self._allocate(images, new_shape, stride, auto)
+        canvas, tensor, rois = self.buffers[key]
+
+        for i, (im, (top, left, h, w)) in enumerate(zip(images, rois)):
+            roi = canvas[i, top:top + h, left:left + w]
+            out = cv2.resize(im, (w, h), dst=roi, interpolation=cv2.INTER_LINEAR)
+            if out is not roi:  # 个别OpenCV版本不支持直接写入子区域
+                roi[...] = out
+        src = torch.from_numpy(canvas)  # BHWC，与画布共享内存
+        if self.raw:
+            return tensor.copy_(src.permute(0, 3, 1, 2))  # BHWC to BCHW, uint8 to fp16/32
+        for c in range(3):
+            tensor[:, c].copy_(src[..., 2 - c])  # BGR to RGB, BHWC to BCHW, uint8 to fp16/32
+        return tensor.div_(255.0)  # 0 - 255 to 0.0 - 1.0
+
+    def _allocate(self, images, new_shape, stride, auto):
+        """按letterbox的规则计算各帧的缩放区域，分配画布和输入张量"""
+        rois, shapes = [], set()
+        for im in images:
+            shape = im.shape[:2]  # current shape [height, width]
+            r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+            h, w = int(round(shape[0] * r)), int(round(shape[1] * r))
+            dh, dw = new_shape[0] - h, new_shape[1] - w  # hw padding
+            if auto:  # minimum rectangle
+                dh, dw = dh % stride, dw % stride
+            rois.append((int(round(dh / 2 - 0.1)), int(round(dw / 2 - 0.1)), h, w))
+            shapes.add((h + dh, w + dw))
+        assert len(shapes) == 1, f'无法拼接尺寸不一致的输入: {shapes}'
+        h, w = shapes.pop()
+        canvas = np.full((len(images), h, w, 3), self.color, dtype=np.uint8)
+        tensor = torch.empty((len(images), 3, h, w), dtype=self.dtype, device=self.device)
+        return canvas, tensor, rois
+
+
+class DetectResult:
+    """单帧检测结果，各目标按数组连续存储，类别名和颜色在使用时才查找"""
+    __slots__ = ('xywh', 'conf', 'cls', 'names', 'colors', 'ids')
+
+    def __init__(self, xywh=None, conf=None, cls=None, names=(), colors=(), ids=None):
+        self.xywh = np.zeros((0, 4), dtype=np.float32) if xywh is None else xywh  # 相对于宽高的坐标(x, y, w, h)
+        self.conf = np.zeros(0, dtype=np.float32) if conf is None else conf  # 置信度
+        self.cls = np.zeros(0, dtype=np.int64) if cls is None else cls  # 类别id
+        self.names = names  # 类别名列表
+        self.colors = colors  # 类别颜色列表
+        self.ids = ids  # 轨迹ID，未跟踪时为None
+
+    def __len__(self):
+        return len(self.conf)
+
+    def name(self, i):
+        """第i个目标的类别名"""
+        c = self.cls[i]
+        return self.names[c] if c < len(self.names) else f'class{c}'  # 非PyTorch模型没有类别名
+
+    def color(self, i):
+        """第i个目标的颜色"""
+        c = self.cls[i]
+        return self.colors[c] if c < len(self.colors) else (0, 255, 0)
+
+    def label(self, i):
+        """第i个目标的标签：类别名、轨迹ID和置信度"""
+        tid = '' if self.ids is None else f' #{self.ids[i]}'
+        return f'{self.name(i)}{tid} {round(float(self.conf[i]), 2)}'
+
+    def tolist(self):
+        """转为字典列表"""
+        return [{'class': self.name(i), 'color': self.color(i), 'confidence': float(self.conf[i]),
+                 'x': float(x), 'y': float(y), 'w': float(w), 'h': float(h),
+                 **({} if self.ids is None else {'id': int(self.ids[i])})}
+                for i, (x, y, w, h) in enumerate(self.xywh)]
 
 
 class YOLO5:
@@ -30,6 +168,10 @@ class YOLO5:
         self.model = None
         self.net = None
         self.session = None
+        self.io_binding = None  # ONNX Runtime IOBinding
+        self.ort_outputs = dict()  # 输入尺寸 -> 预分配的ONNX Runtime输出
+        self.input_name = ''
+        self.output_name = ''
         self.interpreter = None
 
         self.device = None
@@ -42,11 +184,24 @@ class YOLO5:
         self.is_tflite = False
         self.is_pb = False
         self.is_saved_model = False
+        self.is_xml = False
+        self.is_jit = False  # TorchScript
         self.is_int8 = False
 
         self.input_details = []
         self.output_details = []
 
+        self.executable_network = None  # OpenVINO
+        self.ov_input = ''
+        self.ov_output = ''
+        self.ov_next = 0  # 下一个使用的推理请求
+        self.ov_pending = deque()  # 已提交未取回的异步推理 (请求序号, 输入尺寸, 原图)
+
+        self.buffer = None  # 预分配的输入缓冲区
+        self.input_shape = None  # 模型固定的输入尺寸(h, w)，如静态输入的ONNX和TFLite模型
+        self.input_batch = None  # 模型固定的batch大小，如静态batch的ONNX模型
+        self.frame_shape = None  # 固定矩形输入时首帧的尺寸(h, w)
+
     def set_config(self,
                    weights,  # model.pt path(s)
                    device='cpu',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
@@ -57,19 +212,50 @@ class YOLO5:
                    agnostic=True,  # class-agnostic NMS
                    augment=True,  # augmented inference
                    half=True,  # use FP16 half-precision inference
-                   dnn=False  # use OpenCV DNN for ONNX inference
+                   dnn=False,  # use OpenCV DNN for ONNX inference
+                   reuse_buffer=False,  # reuse preallocated input buffers
+                   raw_input=False,  # fold BGR to RGB and 1/255 into the first convolution
+                   ort_intra_threads=0,  # ONNX Runtime intra-op threads, 0 for default
+                   ort_inter_threads=0,  # ONNX Runtime inter-op threads, 0 for default
+                   ort_parallel=False,  # ONNX Runtime parallel execution mode
+                   ort_opt_level='all',  # ONNX Runtime graph optimization level, disable|basic|extended|all
+                   ort_save_optimized=True,  # save the optimized ONNX graph and reuse it on the next start
+                   ort_iobinding=False,  # ONNX Runtime IOBinding with preallocated outputs
+                   ov_requests=2,  # number of OpenVINO async infer requests
+                   quantize=False,  # static INT8 post-training quantization for PyTorch CPU inference
+                   quant_data='',  # calibration images folder for INT8 quantization
+                   compile=False,  # trace, freeze and cache a TorchScript model for the configured input
+                   tile=False,  # tiled inference with overlapping img_size tiles plus a global view
+                   tile_overlap=0.2,  # overlap ratio between adjacent tiles
+                   tta='1, 0.83 lr, 0.67',  # augmented inference scales and flips (lr/ud)
+                   tta_pad=False,  # pad augmented variants to a common shape and run them in a single batch
+                   ensemble_mode='sequential',  # run ensemble members sequential|thread|process
+                   ensemble_merge='nms',  # merge ensemble outputs by nms|wbf (weighted boxes fusion)
+                   nms='greedy',  # NMS engine greedy|matrix|cluster|soft
+                   sparse_decode=False,  # threshold objectness before decoding, only decode candidate anchors
+                   classes='',  # prune the Detect head to these classes (indices or names, comma separated)
+                   rect=False  # fixed rectangular input shape matching the aspect ratio of the first frame
                    ) -> (bool, str):
         """检查参数的正确性并设置参数，参数改变后需要重新设置"""
+        # 多个weights文件用;分隔，组成模型集成
+        files = [w.strip() for w in weights.split(';') if w.strip()] or [weights]
         # 判断weights文件是否真实存在
-        if not os.path.exists(weights):
-            return False, f'Weights文件不存在: {weights}'
+        for w in files:
+            if not os.path.exists(w):
+                return False, f'Weights文件不存在: {w}'
         # 判断文件名后缀是否合法
-        suffix = Path(weights).suffix.lower()
-        suffixes = ['.pt', '.onnx', '.tflite', '.pb', '']
+        suffix = Path(files[0]).suffix.lower()
+        suffixes = ['.pt', '.mmap', '.onnx', '.tflite', '.pb', '.xml', '']
         if suffix not in suffixes:
             return False, f'不合法的文件后缀: \n{weights}'
+        if len(files) > 1 and any(Path(w).suffix.lower() not in ['.pt', '.mmap'] or 'torchscript' in w for w in files):
+            return False, '模型集成仅支持PyTorch模型！'
+        if suffix == '' and Path(weights).name.endswith('_openvino_model'):
+            suffix = '.xml'  # *_openvino_model文件夹
 
-        if suffix == '.pt':
+        self.is_pt = self.is_onnx = self.is_tflite = self.is_pb = self.is_saved_model = self.is_xml = False
+        self.is_jit = self.is_int8 = False
+        if suffix in ['.pt', '.mmap']:  # *.mmap为内存映射的融合模型
             self.is_pt = True
         elif suffix == '.onnx':
             self.is_onnx = True
@@ -77,6 +263,8 @@ class YOLO5:
             self.is_tflite = True
         elif suffix == '.pb':
             self.is_pb = True
+        elif suffix == '.xml':
+            self.is_xml = True
         elif suffix == '':
             self.is_saved_model = True
 
@@ -91,9 +279,9 @@ class YOLO5:
         elif device != 'cpu':
             return False, 'CUDA device 配置错误！'
 
-        # img_size是否64的整数倍
-        if img_size % 64 != 0:
-            return False, 'Image Size应为64的倍数！'
+        # img_size是否32的整数倍
+        if img_size % 32 != 0:
+            return False, 'Image Size应为32的倍数！'
 
         if conf <= 0 or conf >= 1:
             return False, 'Confidence阈值应处于(0, 1)之间！'
@@ -101,9 +289,83 @@ class YOLO5:
         if iou <= 0 or iou >= 1:
             return False, 'IOU阈值应处于(0, 1)之间！'
 
+        if ort_intra_threads < 0 or ort_inter_threads < 0:
+            return False, 'ONNX Runtime线程数不能为负数！'
+
+        if ort_opt_level not in ('disable', 'basic', 'extended', 'all'):
+            return False, f'不合法的ONNX Runtime优化级别: {ort_opt_level}'
+
+        if ov_requests < 1:
+            return False, 'OpenVINO推理请求数应大于0！'
+
+        if quantize and (not self.is_pt or 'torchscript' in weights):
+            return False, 'INT8量化仅支持PyTorch模型！'
+
+        if quantize and device != 'cpu':
+            return False, 'INT8量化仅支持CPU推理，请将CUDA device设置为"cpu"！'
+
+        if quantize and not os.path.isdir(quant_data):
+            return False, f'INT8量化校准图片文件夹不存在: {quant_data}'
+
+        if quantize and not any(f.suffix[1:].lower() in IMG_FORMATS + VID_FORMATS for f in Path(quant_data).iterdir()):
+            return False, f'INT8量化校准文件夹中没有图片: {quant_data}'
+
+        if compile and (not self.is_pt or 'torchscript' in weights):
+            return False, 'TorchScript编译仅支持PyTorch模型！'
+
+        if compile and (augment or quantize):
+            return False, 'TorchScript编译不支持Augment和INT8量化！'
+
+        if len(files) > 1 and (quantize or compile):
+            return False, '模型集成不支持TorchScript编译和INT8量化！'
+
+        if ensemble_mode not in ('sequential', 'thread', 'process'):
+            return False, f'不合法的模型集成运行方式: {ensemble_mode}'
+
+        if ensemble_merge not in ('nms', 'wbf'):
+            return False, f'不合法的模型集成合并方式: {ensemble_merge}'
+
+        classes = [c.strip() for c in classes.split(',') if c.strip()]
+        if classes and (not self.is_pt or any('torchscript' in w for w in files)):
+            return False, '类别筛选仅支持PyTorch模型！'
+        if any(re.match(r'^-\d+$', c) for c in classes):
+            return False, '类别序号不能为负数！'
+        for w in files:  # *.mmap的类别名可直接读取，*.pt的类别在加载模型时检查
+            names = load_mmap_header(w)[0]['names'] if w.lower().endswith('.mmap') else None
+            unknown = [c for c in classes if names and (int(c) >= len(names) if c.isdigit() else c not in names)]
+            if unknown:
+                return False, f'类别不存在: {", ".join(unknown)}'
+
+        if tile and self.is_xml:
+            return False, 'OpenVINO模型不支持切分图块！'
+
+        if rect and (tile or compile):
+            return False, '固定矩形输入不支持切分图块和TorchScript编译！'
+
+        # OpenVINO、TFLite及静态输入尺寸的ONNX模型只能按导出时的输入尺寸推理
+        shape = onnx_input_shape(files[0]) if self.is_onnx else None
+        if rect and (self.is_xml or self.is_tflite or (shape and all(isinstance(x, int) for x in shape[2:]))):
+            return False, '固定矩形输入不支持OpenVINO、TFLite及静态输入尺寸的ONNX模型！'
+
+        if nms not in NMS_ENGINES:
+            return False, f'不合法的NMS引擎: {nms}'
+
         if half and device == 'cpu':
             return False, '当前CUDA device配置为"cpu"，Half不可用！'
 
+        if not 0 <= tile_overlap < 0.5:
+            return False, '图块重叠比例应处于[0, 0.5)之间！'
+
+        try:
+            tta = parse_tta(tta)
+        except ValueError as e:
+            return False, f'不合法的TTA配置: {e}'
+
+        # 由已合并输入归一化的模型保存的*.mmap只接受原始BGR输入，与Raw input设置无关
+        if not raw_input and any(load_mmap_header(w)[0].get('raw_input') for w in files if w.lower().endswith('.mmap')):
+            YOLOGGER.info('*.mmap模型已合并输入归一化，使用原始BGR输入')
+            raw_input = True
+
         # 初始化配置
         self.opt = {
             'weights': weights,
@@ -115,41 +377,112 @@ class YOLO5:
             'agnostic_nms': agnostic,
             'augment': augment,
             'half': half,
-            'dnn': dnn
+            'dnn': dnn,
+            'reuse_buffer': reuse_buffer,
+            'raw_input': raw_input and suffix in ['.pt', '.mmap'] and 'torchscript' not in weights,
+            'ort_intra_threads': ort_intra_threads,
+            'ort_inter_threads': ort_inter_threads,
+            'ort_parallel': ort_parallel,
+            'ort_opt_level': ort_opt_level,
+            'ort_save_optimized': ort_save_optimized,
+            'ort_iobinding': ort_iobinding,
+            'ov_requests': ov_requests,
+            'quantize': quantize,
+            'quant_data': quant_data,
+            'compile': compile,
+            'tile': tile,
+            'tile_overlap': tile_overlap,
+            'tta': tta,
+            'tta_pad': tta_pad,
+            'ensemble': files if len(files) > 1 else [],
+            'ensemble_mode': ensemble_mode,
+            'ensemble_merge': ensemble_merge,
+            'nms': nms,
+            'sparse_decode': sparse_decode,
+            'classes': classes,
+            'rect': rect
         }
         return True, ''
 
     def load_model(self):
         """加载模型，参数改变后需要重新加载模型"""
+        if isinstance(self.model, Ensemble):
+            self.model.close()  # 结束上一个模型集成的线程或进程
+        self.input_shape = self.input_batch = self.frame_shape = None
         # Initialize
         self.device = select_device(self.opt['device'])
         half = self.opt.get('half') and self.device.type != 'cpu'  # half precision only supported on CUDA
 
         w = self.opt['weights']
         if self.is_pt:
-            # Load model
-            self.model = torch.jit.load(w) if 'torchscript' in w else attempt_load(w, map_location=self.device)
-            self.stride = int(self.model.stride.max())  # model stride
+            self.is_jit = 'torchscript' in w or self.opt.get('compile')
+            if 'torchscript' in w:
+                self.load_torchscript(w)
+                if half:
+                    self.model.half()  # to FP16
+            elif self.opt.get('compile'):
+                if not self.load_compiled_model(w, half):
+                    return False
+            else:
+                # Load model
+                self.model = attempt_load(self.opt.get('ensemble') or w, map_location=self.device,
+                                          raw_input=self.opt.get('raw_input'))
+                models = [m for m in self.model.modules() if isinstance(m, Model)]  # Ensemble中的各个模型
+                if not self.opt.get('raw_input') and any(m.raw_input for m in models):  # 以模型实际的输入为准
+                    for m in models:
+                        m.fold_input()
+                    self.opt['raw_input'] = True
+                if not self.prune_classes(self.model):
+                    return False
+                self.stride = int(self.model.stride.max())  # model stride
+                self.names = self.model.module.names if hasattr(self.model, 'module') else self.model.names
+                if half:
+                    self.model.half()  # to FP16
+                if self.opt.get('quantize'):
+                    self.model = self.load_int8_model(w)
+                    if self.model is None:
+                        return False
+                for m in self.model.modules():  # Ensemble中的各个模型
+                    if isinstance(m, Model):
+                        m.tta_scales, m.tta_flips = self.opt.get('tta', (Model.tta_scales, Model.tta_flips))
+                        m.tta_pad = self.opt.get('tta_pad', False)
+                        m.model[-1].conf_thres = self.opt['conf_thresh'] if self.opt.get('sparse_decode') else 0
+                if isinstance(self.model, Ensemble):
+                    self.model.merge = self.opt.get('ensemble_merge', 'nms')
+                    self.model.conf_thres, self.model.iou_thres = self.opt['conf_thresh'], self.opt['iou_thresh']
+                    self.model.max_det = self.opt['max_det']
+                    mode = self.opt.get('ensemble_mode', 'sequential')
+                    self.model.parallel(None if mode == 'sequential' else mode)
 
-            # Get names and colors
-            self.names = self.model.module.names if hasattr(self.model, 'module') else self.model.names
+            # Get colors
             self.colors = [[np.random.randint(0, 255) for _ in range(3)] for _ in range(len(self.names))]
-            if half:
-                self.model.half()  # to FP16
         elif self.is_onnx:
             if self.opt['dnn']:
                 # check_requirements(('opencv-python>=4.5.4',))
                 self.net = cv2.dnn.readNetFromONNX(w)
+                batch = (onnx_input_shape(w) or [None])[0]
+                self.input_batch = batch if isinstance(batch, int) else None  # 静态batch大小
             else:
                 try:
                     pkg.require(('onnx', 'onnxruntime'))
                 except pkg.DistributionNotFound as error:
                     YOLOGGER.error(error)
                 else:
-                    import onnxruntime
-                    self.session = onnxruntime.InferenceSession(w, None)
+                    self.load_onnx_session(w)
+        elif self.is_xml:
+            try:
+                pkg.require('openvino')
+            except pkg.DistributionNotFound as error:
+                YOLOGGER.error(error)
+            else:
+                self.load_openvino_network(w)
         else:  # TensorFlow models
-            if SUPPORT_TENSORFLOW:
+            try:
+                pkg.require('tensorflow>=2.4.1')
+            except pkg.DistributionNotFound as error:
+                YOLOGGER.error(error)
+            else:
+                import tensorflow as tf  # 仅在使用TensorFlow模型时导入
                 if self.is_pb:  # https://www.tensorflow.org/guide/migrate#a_graphpb_or_graphpbtxt
                     def wrap_frozen_graph(gd, inputs, outputs):
                         x = tf.compat.v1.wrap_function(lambda: tf.compat.v1.import_graph_def(gd, name=""), [])  # wrapped import
@@ -167,51 +500,418 @@ class YOLO5:
                     self.input_details = self.interpreter.get_input_details()  # inputs
                     self.output_details = self.interpreter.get_output_details()  # outputs
                     self.is_int8 = self.input_details[0]['dtype'] == np.uint8  # is TFLite quantized uint8 model
+                    self.input_shape = tuple(int(x) for x in self.input_details[0]['shape'][1:3])  # 导出时的输入尺寸
         self.opt['img_size'] = check_img_size(self.opt['img_size'], s=self.stride)  # check img_size
+        self.buffer = InputBuffer(self.device, half=self.is_pt and half, raw=self.opt.get('raw_input')) \
+            if self.opt.get('reuse_buffer') else None
         imgsz = self.opt['img_size']
         if self.is_pt and self.device.type != 'cpu':
-            self.model(torch.zeros(1, 3, imgsz, imgsz).to(self.device).type_as(next(self.model.parameters())))  # run once
+            self.model(torch.zeros(1, 3, imgsz, imgsz, device=self.device, dtype=torch.half if half else torch.float))  # run once
         return True
 
-    def obj_detect(self, image):
-        objects = []  # 返回目标列表
-        img_h, img_w, _ = image.shape
+    def load_torchscript(self, w):
+        """加载TorchScript模型，stride和names从模型附带的config.txt中读取"""
+        extra_files = {'config.txt': ''}  # model metadata
+        self.model = torch.jit.load(w, map_location=self.device, _extra_files=extra_files)
+        if extra_files['config.txt']:
+            d = json.loads(extra_files['config.txt'])  # extra_files dict
+            self.stride, self.names = int(d['stride']), d['names']
 
-        # Padded resize
-        img = letterbox(image, new_shape=self.opt['img_size'], stride=self.stride)[0]
-        img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB
-        img = np.ascontiguousarray(img)  # 转换为内存连续存储的数组
-        if self.is_onnx:
-            img = img.astype('float32')
+    def load_compiled_model(self, w, half):
+        """加载按权重哈希、输入尺寸、精度、设备和torch版本缓存的TorchScript模型，不存在时trace并freeze后缓存"""
+        with open(w, 'rb') as f:
+            sha = hashlib.sha256(f.read()).hexdigest()[:16]  # 权重文件哈希
+        imgsz = self.opt['img_size']
+        key = f'{sha}_{imgsz}_{"fp16" if half else "fp32"}_{self.device.type}{"_raw" if self.opt.get("raw_input") else ""}'
+        key += self.classes_suffix()
+        f = Path('cache') / f'{key}_torch{torch.__version__.split("+")[0]}.torchscript'
+        if f.exists():
+            YOLOGGER.info(f'加载TorchScript模型缓存: {f}')
+            os.utime(f)  # 记录最近使用时间
+            self.load_torchscript(str(f))
+            return True
+
+        model = attempt_load(w, map_location=self.device, raw_input=self.opt.get('raw_input'))
+        if not self.prune_classes(model):
+            return False
+        self.stride = int(model.stride.max())  # model stride
+        self.names = model.module.names if hasattr(model, 'module') else model.names
+        if half:
+            model.half()  # to FP16
+        YOLOGGER.info(f'开始编译TorchScript模型: {f}')
+        im = torch.zeros(1, 3, imgsz, imgsz, device=self.device, dtype=torch.half if half else torch.float)
+        with torch.no_grad():
+            model(im)  # dry run，生成Detect的grid
+            self.model = torch.jit.freeze(torch.jit.trace(model, im, strict=False))
+        f.parent.mkdir(exist_ok=True)
+        torch.jit.save(self.model, str(f), _extra_files={'config.txt': json.dumps({'stride': self.stride,
+                                                                                    'names': self.names})})
+        clean_cache(str(f.parent))
+        return True
+
+    def prune_classes(self, model):
+        """按配置的类别(序号或类别名)裁剪检测头，只计算这些类别的输出，检测结果的类别序号对应裁剪后的names"""
+        if not self.opt.get('classes'):
+            return True
+        names = model.module.names if hasattr(model, 'module') else model.names
+        classes = []
+        for c in self.opt['classes']:
+            i = int(c) if c.isdigit() else names.index(c) if c in names else -1
+            if not 0 <= i < len(names):
+                YOLOGGER.error(f'类别不存在: {c}')
+                return False
+            classes.append(i)
+        for m in model.modules():  # Ensemble中的各个模型
+            if isinstance(m, Model):
+                m.prune_classes(classes)
+        if isinstance(model, Ensemble):
+            model.names = model[-1].names
+        return True
+
+    def classes_suffix(self):
+        """类别筛选对应的模型缓存文件名后缀"""
+        classes = ','.join(self.opt.get('classes', []))
+        return f'_c{hashlib.sha256(classes.encode()).hexdigest()[:8]}' if classes else ''
+
+    def quant_suffix(self):
+        """INT8量化校准图片对应的模型缓存文件名后缀，更换校准文件夹或其中的文件后重新校准"""
+        data = Path(self.opt.get('quant_data', ''))
+        files = sorted(f'{f.name}:{f.stat().st_mtime_ns}' for f in data.iterdir() if f.is_file()) \
+            if data.is_dir() else []
+        key = '\n'.join([str(data.resolve())] + files)
+        return f'_q{hashlib.sha256(key.encode()).hexdigest()[:8]}'
+
+    def load_int8_model(self, w):
+        """加载INT8量化模型，不存在或已过期时用校准图片生成并缓存到权重文件旁"""
+        raw = '_raw' if self.opt.get('raw_input') else ''
+        f = Path(w).with_name(f'{Path(w).stem}_int8{raw}{self.classes_suffix()}{self.quant_suffix()}.pt')  # 量化模型缓存
+        if f.exists() and f.stat().st_mtime >= os.path.getmtime(w):
+            YOLOGGER.info(f'加载INT8量化模型: {f}')
+            ckpt = torch.load(f, map_location='cpu')
+            model = quantize_int8(self.model, [], backend=ckpt['backend'])  # 量化模型结构，参数从缓存加载
+            model.load_state_dict(ckpt['model'])
+            return model
+
+        data = self.opt['quant_data']
+        if not os.path.isdir(data):
+            YOLOGGER.error(f'INT8量化校准图片文件夹不存在: {data}')
+            return None
+        YOLOGGER.info(f'开始INT8量化校准: {data}')
+        self.opt['img_size'] = check_img_size(self.opt['img_size'], s=self.stride)
+        images = []
+        try:
+            for _, _, im0, _, _ in LoadImages(data, img_size=self.opt['img_size'], stride=self.stride):
+                images.append(self.preprocess([im0]).clone())
+                if len(images) >= 32:  # 校准图片数量
+                    break
+        except AssertionError as e:  # 文件夹中没有图片或视频
+            YOLOGGER.error(f'INT8量化校准失败: {e}')
+            return None
+        model = quantize_int8(self.model, images)
+
+        # 各层相对FP32模型的误差，及实测的推理耗时
+        drift = int8_drift(self.model, model, images)
+        report = [f'{"layer":<40}{"drift":>10}'] + [f'{k:<40}{v:>10.4f}' for k, v in drift.items()]
+        t_fp32, t_int8 = int8_speedup(self.model, model, images[0])
+        report.append(f'FP32 {t_fp32:.1f}ms, INT8 {t_int8:.1f}ms, speedup {t_fp32 / t_int8:.2f}x '
+                      f'({torch.get_num_threads()} threads, input {list(images[0].shape[2:])})')
+        for line in report:
+            YOLOGGER.info(line)
+        if t_fp32 / t_int8 < 1.5:
+            YOLOGGER.warning(f'INT8量化仅加速{t_fp32 / t_int8:.2f}倍，激活函数等仍以FP32计算，加速不明显')
+        f.with_suffix('.txt').write_text('\n'.join(report) + '\n')
+        torch.save({'model': model.state_dict(), 'backend': model.int8}, f)  # 量化模块不支持直接序列化
+        YOLOGGER.info(f'INT8量化模型已保存: {f}')
+        return model
+
+    def load_onnx_session(self, w):
+        """按配置创建ONNX Runtime会话，优化后的模型保存到权重文件旁，下次启动直接加载
+
+        'all'级别的优化(如NCHWc布局)与硬件相关，只保存'extended'级别的优化结果，'all'级别的优化在每次加载时进行；
+        保存的文件名包含推理后端和ONNX Runtime版本，更换设备或升级后重新优化
+        """
+        import onnxruntime
+        ort = onnxruntime.GraphOptimizationLevel
+        levels = {'disable': ort.ORT_DISABLE_ALL, 'basic': ort.ORT_ENABLE_BASIC,
+                  'extended': ort.ORT_ENABLE_EXTENDED, 'all': ort.ORT_ENABLE_ALL}
+        level = self.opt['ort_opt_level']
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.opt['ort_intra_threads']
+        options.inter_op_num_threads = self.opt['ort_inter_threads']
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL if self.opt['ort_parallel'] \
+            else onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = levels[level]
+
+        providers = ['CPUExecutionProvider']
+        if self.device.type != 'cpu' and 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+
+        saved = 'extended' if level == 'all' else level  # 保存的优化级别
+        backend = '-'.join(p.replace('ExecutionProvider', '').lower() for p in providers)
+        optimized = Path(w).with_name(f'{Path(w).stem}_ort_{saved}_{backend}_{onnxruntime.__version__}.onnx')
+        if self.opt['ort_save_optimized'] and level != 'disable':
+            if optimized.exists() and optimized.stat().st_mtime >= os.path.getmtime(w):
+                YOLOGGER.info(f'加载已优化的ONNX模型: {optimized}')
+            else:
+                save_options = onnxruntime.SessionOptions()
+                save_options.graph_optimization_level = levels[saved]
+                save_options.optimized_model_filepath = str(optimized)
+                onnxruntime.InferenceSession(w, save_options, providers=providers)  # 仅用于保存优化后的模型
+                YOLOGGER.info(f'已保存优化后的ONNX模型: {optimized}')
+            w = str(optimized)
+            # 已优化过，'all'级别只需再进行与硬件相关的优化
+            options.graph_optimization_level = levels['all'] if level == 'all' else ort.ORT_DISABLE_ALL
+        self.session = onnxruntime.InferenceSession(w, options, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        shape = self.session.get_inputs()[0].shape  # 动态维度为字符串
+        self.input_shape = tuple(shape[2:]) if all(isinstance(x, int) for x in shape[2:]) else None  # 静态输入尺寸
+        self.input_batch = shape[0] if isinstance(shape[0], int) else None  # 静态batch大小
+        self.output_name = self.session.get_outputs()[0].name
+        self.io_binding = self.session.io_binding() if self.opt['ort_iobinding'] else None
+        self.ort_outputs = dict()
+
+    def run_onnx_session(self, im):
+        """ONNX Runtime推理，使用IOBinding时输出写入预分配的缓冲区，缓冲区会在下一次推理时被覆盖"""
+        if self.io_binding is None:
+            return self.session.run([self.output_name], {self.input_name: im})[0]
+
+        self.io_binding.bind_cpu_input(self.input_name, im)
+        out = self.ort_outputs.get(im.shape)
+        if out is None:  # 首次遇到该输入尺寸，由ONNX Runtime分配输出后按其形状预分配
+            self.io_binding.bind_output(self.output_name)
+            self.session.run_with_iobinding(self.io_binding)
+            out = self.io_binding.copy_outputs_to_cpu()[0]
+            self.ort_outputs[im.shape] = out
         else:
-            img = torch.from_numpy(img).to(self.device)
-            img = img.half() if self.opt.get('half') else img.float()  # uint8 to fp16/32
+            self.io_binding.bind_output(self.output_name, 'cpu', 0, out.dtype, out.shape, out.ctypes.data)
+            self.session.run_with_iobinding(self.io_binding)
+        return out
 
-        img = img / 255.0  # 0 - 255 to 0.0 - 1.0
-        if len(img.shape) == 3:
-            img = img[None]  # expand for batch dim
+    def load_openvino_network(self, w):
+        """加载OpenVINO模型，创建多个推理请求用于异步推理"""
+        import openvino.inference_engine as ie
+        core = ie.IECore()
+        if not Path(w).is_file():  # if not *.xml
+            w = next(Path(w).glob('*.xml'))  # get *.xml file from *_openvino_model dir
+        network = core.read_network(model=w, weights=Path(w).with_suffix('.bin'))  # *.xml, *.bin paths
+        self.ov_input = next(iter(network.input_info))
+        self.ov_output = next(k for k, v in network.outputs.items() if len(v.shape) == 3)  # (bs, n, 85)
+        self.opt['img_size'] = list(network.input_info[self.ov_input].input_data.shape[2:])  # 输入尺寸固定
+        self.executable_network = core.load_network(network, device_name='CPU', num_requests=self.opt['ov_requests'])
+        self.ov_next = 0
+        self.ov_pending.clear()
 
-        if img.ndimension() == 3:
-            img = img.unsqueeze(0)  # 添加一维
+    def obj_detect_async(self, image):
+        """OpenVINO异步检测，提交当前帧并返回最早提交的一帧的检测结果，推理请求未占满时返回None
 
-        # Inference
-        if self.is_pt:
-            pred = self.model(img, augment=self.opt['augment'])[0]
+        当前帧的预处理与之前提交的帧的推理同时进行，检测结果滞后于当前帧ov_requests帧
+        """
+        img = self.preprocess([image])
+        results = None
+        if len(self.ov_pending) == len(self.executable_network.requests):  # 推理请求已全部占用
+            results = self.collect_async()
+        rid = self.ov_next
+        self.ov_next = (rid + 1) % len(self.executable_network.requests)
+        self.executable_network.requests[rid].async_infer({self.ov_input: img.cpu().numpy()})
+        self.ov_pending.append((rid, img.shape[2:], image))
+        return results
+
+    def collect_async(self):
+        """等待最早提交的异步推理完成并返回其检测结果"""
+        rid, shape, image = self.ov_pending.popleft()
+        request = self.executable_network.requests[rid]
+        request.wait()
+        pred = torch.tensor(request.output_blobs[self.ov_output].buffer)
+        return self.postprocess(pred, shape, [image])[0]
+
+    def flush_async(self):
+        """等待并返回所有未取回的异步检测结果"""
+        return [self.collect_async() for _ in range(len(self.ov_pending))]
+
+    def obj_detect(self, image, img_size=None, augment=None):
+        """检测单帧图像，返回目标列表，img_size和augment不为None时临时覆盖配置(用于降级检测，不切分图块)"""
+        if self.opt.get('tile') and img_size is None and augment is None:
+            return self.obj_detect_tiled(image)
+        return self.obj_detect_batch([image], img_size=img_size, augment=augment)[0]
+
+    def warmup(self, shape, sizes):
+        """按帧尺寸预热各推理分辨率(输入缓冲区、各层网格和推理后端)，切换分辨率时不再卡顿"""
+        image = np.zeros(shape, dtype=np.uint8)
+        for s in sizes:
+            self.obj_detect(image, img_size=s)
+
+    @torch.no_grad()
+    def obj_detect_tiled(self, image):
+        """切分图块检测高分辨率图像，所有图块和全局视图拼接为一个batch推理"""
+        crops, offsets = self.tile(image)
+        img = self.preprocess(crops)
+        pred = self.inference(img)
+        return self.merge_tiles(pred, img.shape[2:], crops, offsets, image)
+
+    def tile(self, image, texture=4.0):
+        """将图像切分为有重叠的img_size大小的图块，并附加整幅图像作为全局视图(检测大目标)
+
+        灰度标准差小于texture的图块(纯色天空、墙面等)不可能有目标，直接跳过
+        返回(图块列表, 各图块左上角在原图中的坐标)，全局视图的坐标为None
+        """
+        s = self.opt['img_size']
+        h, w = image.shape[:2]
+        if h <= s and w <= s:  # 不需要切分
+            return [image], [None]
+        step = max(int(s * (1 - self.opt['tile_overlap'])), 1)
+        ys = list(range(0, max(h - s, 0) + 1, step))
+        xs = list(range(0, max(w - s, 0) + 1, step))
+        if ys[-1] + s < h:
+            ys.append(h - s)  # 最后一行图块与下边缘对齐
+        if xs[-1] + s < w:
+            xs.append(w - s)  # 最后一列图块与右边缘对齐
+        gray = cv2.cvtColor(cv2.resize(image, (max(w // 8, 1), max(h // 8, 1)), interpolation=cv2.INTER_AREA),
+                            cv2.COLOR_BGR2GRAY)  # 缩小8倍的灰度图，用于估计各图块的纹理
+        crops, offsets = [], []
+        for y in ys:
+            for x in xs:
+                if gray[y // 8:(y + s) // 8, x // 8:(x + s) // 8].std() < texture:
+                    continue
+                crops.append(image[y:y + s, x:x + s])
+                offsets.append((x, y))
+        crops.append(image)
+        offsets.append(None)
+        return crops, offsets
+
+    def merge_tiles(self, pred, shape, crops, offsets, image):
+        """各图块分别NMS后还原到原图坐标，丢弃被图块内侧边界截断的框，再整体NMS合并"""
+        import torchvision  # lazy import
+
+        pred = non_max_suppression(pred, self.opt['conf_thresh'], self.opt['iou_thresh'], classes=None,
+                                   agnostic=self.opt['agnostic_nms'], max_det=self.opt['max_det'],
+                                   engine=self.opt.get('nms', 'greedy'))
+        h, w = image.shape[:2]
+        dets = []
+        for det, crop, offset in zip(pred, crops, offsets):
+            det = det.float().cpu()
+            det[:, :4] = scale_coords(shape, det[:, :4], crop.shape)
+            if offset is not None:
+                x, y = offset
+                ch, cw = crop.shape[:2]
+                # 被截断的目标由相邻图块(重叠区域内)或全局视图完整检测
+                cut = ((det[:, 0] < 2) & (x > 0)) | ((det[:, 1] < 2) & (y > 0)) | \
+                      ((det[:, 2] > cw - 2) & (x + cw < w)) | ((det[:, 3] > ch - 2) & (y + ch < h))
+                det = det[~cut]
+                det[:, :4] += torch.tensor([x, y, x, y], dtype=det.dtype)
+            dets.append(det)
+        det = torch.cat(dets, 0)
+        classes = torch.zeros_like(det[:, 5]) if self.opt['agnostic_nms'] else det[:, 5]
+        i = torchvision.ops.batched_nms(det[:, :4], det[:, 4], classes, self.opt['iou_thresh'])
+        det = det[i[:self.opt['max_det']]].numpy()[::-1]  # 按置信度升序，置信度高的目标后绘制
+        return self.to_result(det[:, :4].round(), det[:, 4].copy(), det[:, 5].astype(np.int64), image)
+
+    def to_result(self, xyxy, conf, cls, image):
+        """原图坐标的(x1, y1, x2, y2)检测框转为DetectResult"""
+        img_h, img_w, _ = image.shape
+        xywh = np.concatenate((xyxy[:, :2], xyxy[:, 2:] - xyxy[:, :2]), 1) / [img_w, img_h, img_w, img_h]
+        return DetectResult(xywh.astype(np.float32), conf, cls, self.names, self.colors)
+
+    @torch.no_grad()
+    def obj_detect_batch(self, images, img_size=None, augment=None):
+        """批量检测多帧图像，N帧拼接为一个batch，只做一次前向推理和一次NMS，返回每帧的目标列表
+
+        静态batch的ONNX模型按其batch大小分批推理
+        """
+        img = self.preprocess(images, img_size=img_size)
+        pred = self.inference(img, augment=augment)
+        return self.postprocess(pred, img.shape[2:], images)
+
+    @property
+    def resizable(self):
+        """是否支持逐帧改变输入尺寸，OpenVINO、编译后的模型及导出的模型输入尺寸固定"""
+        return self.is_pt and not self.is_jit
+
+    def fix_shape(self, shape):
+        """按首帧的宽高比固定矩形输入尺寸，并预热该尺寸(各层网格、输入缓冲区和推理后端)"""
+        self.frame_shape = tuple(shape[:2])
+        YOLOGGER.info(f'固定输入尺寸: {self.rect_shape(self.opt["img_size"])}')
+        self.warmup(shape, [self.opt['img_size']])
+
+    def rect_shape(self, img_size):
+        """与首帧宽高比一致的输入尺寸(h, w)，长边为img_size，短边向上取整到stride的整数倍"""
+        h, w = self.frame_shape
+        short = min(math.ceil(img_size * min(h, w) / max(h, w) / self.stride) * self.stride, img_size)
+        return (img_size, short) if h > w else (short, img_size)
+
+    def preprocess(self, images, img_size=None):
+        """Padded resize并拼接为BCHW的输入张量"""
+        img_size = img_size or self.opt['img_size']
+        if self.opt.get('rect') and self.frame_shape is None and self.input_shape is None:
+            self.fix_shape(images[0].shape)
+        # 各帧尺寸一致时使用最小矩形填充，否则统一填充到img_size以便拼接；OpenVINO和编译后的模型输入尺寸固定
+        auto = not (self.is_xml or self.opt.get('compile')) and len(set(im.shape for im in images)) == 1
+        if self.input_shape is not None:  # 模型的输入尺寸固定
+            img_size, auto = self.input_shape, False
+        elif self.frame_shape is not None and isinstance(img_size, int):  # 固定矩形输入
+            img_size, auto = self.rect_shape(img_size), False
+        if self.buffer is not None:
+            return self.buffer.load(images, img_size, stride=self.stride, auto=auto)
+        img = [letterbox(im, new_shape=img_size, stride=self.stride, auto=auto)[0] for im in images]
+        img = np.stack(img, 0)
+        if self.opt.get('raw_input'):  # 通道翻转和归一化已合并到第一层卷积中，传输uint8的BGR图像即可
+            img = torch.from_numpy(img).to(self.device).permute(0, 3, 1, 2).contiguous()  # BHWC to BCHW
+            return img.half() if self.opt.get('half') else img.float()  # uint8 to fp16/32
+        img = img[..., ::-1].transpose(0, 3, 1, 2)  # BGR to RGB, BHWC to BCHW
+        img = np.ascontiguousarray(img)  # 转换为内存连续存储的数组
+        img = torch.from_numpy(img).to(self.device)
+        img = img.half() if self.is_pt and self.opt.get('half') else img.float()  # uint8 to fp16/32
+        img /= 255.0  # 0 - 255 to 0.0 - 1.0
+        return img
+
+    def inference(self, img, augment=None):
+        """对BCHW的输入张量进行推理，返回(bs, n, 85)的预测结果"""
+        if self.is_jit:
+            pred = self.model(img)[0]
+        elif self.is_pt:
+            pred = self.model(img, augment=self.opt['augment'] if augment is None else augment)[0]
         elif self.is_onnx:
-            if self.opt['dnn']:
-                self.net.setInput(img)
-                pred = torch.tensor(self.net.forward())
-            else:
-                result = self.session.run(
-                    [self.session.get_outputs()[0].name], {self.session.get_inputs()[0].name: img})
-                pred = torch.tensor(result)
+            im = img.cpu().numpy()  # torch to numpy
+            b = self.input_batch or len(im)  # 静态batch的模型按导出时的batch大小分批推理，最后一批补零
+            pred = []
+            for i in range(0, len(im), b):
+                x = im[i:i + b]
+                if len(x) < b:
+                    x = np.concatenate((x, np.zeros((b - len(x), *x.shape[1:]), dtype=x.dtype)), 0)
+                if self.opt['dnn']:
+                    self.net.setInput(x)
+                    y = self.net.forward()
+                else:
+                    y = self.run_onnx_session(x)
+                y = y[:len(im) - i]
+                pred.append(torch.from_numpy(y.copy() if len(im) > b else y))  # IOBinding的输出缓冲区会被下一批覆盖
+            pred = torch.cat(pred, 0) if len(pred) > 1 else pred[0]
+        elif self.is_xml:
+            self.flush_async()  # 丢弃未取回的异步推理
+            im = img.cpu().numpy()
+            requests = self.executable_network.requests
+            pred = []
+            for i in range(0, len(im), len(requests)):  # batch中的各帧分配到多个推理请求上同时推理
+                batch = im[i:i + len(requests)]
+                for request, x in zip(requests, batch):
+                    request.async_infer({self.ov_input: x[None]})
+                for request, _ in zip(requests, batch):
+                    request.wait()
+                    pred.append(torch.tensor(request.output_blobs[self.ov_output].buffer))
+            pred = torch.cat(pred, 0)
         else:  # tensorflow model (tflite, pb, saved_model)
             imn = img.permute(0, 2, 3, 1).cpu().numpy()  # image in numpy
             if self.is_pb:
+                import tensorflow as tf  # 已在load_model中导入
                 pred = self.frozen_func(x=tf.constant(imn)).numpy()
             elif self.is_saved_model:
                 pred = self.model(imn, training=False).numpy()
             elif self.is_tflite:
+                if tuple(self.input_details[0]['shape']) != imn.shape:  # batch大小或输入尺寸改变
+                    self.interpreter.resize_tensor_input(self.input_details[0]['index'], imn.shape)
+                    self.interpreter.allocate_tensors()
+                    self.input_details = self.interpreter.get_input_details()
+                    self.output_details = self.interpreter.get_output_details()
                 if self.is_int8:
                     scale, zero_point = self.input_details[0]['quantization']
                     imn = (imn / scale + zero_point).astype(np.uint8)  # de-scale
@@ -221,33 +921,28 @@ class YOLO5:
                 if self.is_int8:
                     scale, zero_point = self.output_details[0]['quantization']
                     pred = (pred.astype(np.float32) - zero_point) * scale  # re-scale
-            imgsz = self.opt['img_size']
-            pred[..., 0] *= imgsz[1]  # x
-            pred[..., 1] *= imgsz[0]  # y
-            pred[..., 2] *= imgsz[1]  # w
-            pred[..., 3] *= imgsz[0]  # h
+            h, w = img.shape[2:]
+            pred[..., :4] *= [w, h, w, h]  # xywh normalized to pixels
             pred = torch.tensor(pred)
+        return pred
 
+    def postprocess(self, pred, shape, images):
+        """NMS并将检测框还原到各帧原图坐标，shape为推理时的输入尺寸(h, w)"""
         # Apply NMS
         pred = non_max_suppression(pred, self.opt['conf_thresh'], self.opt['iou_thresh'], classes=None,
-                                   agnostic=self.opt['agnostic_nms'], max_det=self.opt['max_det'])
+                                   agnostic=self.opt['agnostic_nms'], max_det=self.opt['max_det'],
+                                   engine=self.opt.get('nms', 'greedy'))
 
         # # Second-stage classifier (optional)
         # if classify:
         #     pred = apply_classifier(pred, modelc, img, im0s)
 
-        # Process detections
-        for i, det in enumerate(pred):  # detections per image
-            gn = torch.tensor(image.shape)[[1, 0, 1, 0]]  # normalization gain whwh
-            if det is not None and len(det):
-                # Rescale boxes from img_size to image size
-                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], image.shape).round()
-
-                # Write results
-                for *xyxy, conf, cls in reversed(det):
-                    xyxy = [xy.item() for xy in xyxy]  # tensor列表转为一般列表
-                    xywh = [xyxy[0] / img_w, xyxy[1] / img_h,
-                            (xyxy[2] - xyxy[0]) / img_w, (xyxy[3] - xyxy[1]) / img_h]  # 转相对于宽高的坐标
-                    objects.append({'class': self.names[int(cls)], 'color': self.colors[int(cls)],
-                                    'confidence': conf.item(), 'x': xywh[0], 'y': xywh[1], 'w': xywh[2], 'h': xywh[3]})
-        return objects
+        # Process detections，整个batch的检测结果一次拷贝到CPU
+        dets = np.split(torch.cat(pred, 0).float().cpu().numpy(), np.cumsum([len(det) for det in pred])[:-1])
+        results = []  # 每帧的检测结果
+        for det, image in zip(dets, images):  # detections per image
+            det = det[::-1]  # 按置信度升序，置信度高的目标后绘制
+            # Rescale boxes from img_size to image size
+            xyxy = scale_coords(shape, det[:, :4].copy(), image.shape).round()
+            results.append(self.to_result(xyxy, det[:, 4].copy(), det[:, 5].astype(np.int64), image))
+        return results